@@ -0,0 +1,248 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import pandas as pd
+import bson
+from bson.objectid import ObjectId
+
+from utils.settings_cash_points import input_output_dict, query_cash_points, projection_cash_points, dtypes_cash_points, pipeline_cash_points, clean_cash, clean_points
+from utils.table_utils import ExtractionSession, DedupeIndex, current_rss_mb, frame_bytes
+from log.log_config import log_config
+
+# Offline benchmark of extract -> clean -> load on synthetic hotel_calendar(_cash) documents, reporting docs/sec, MB/sec
+# and peak RSS per stage at several chunk sizes. Runs against an in-process mongomock and a SQLite file by default,
+# or a local mongod / Postgres via --mongo_uri / --postgres_uri. Compare runs with --output_csv before and after a change
+
+benchmark_database = 'odynn_benchmark'
+benchmark_tables = {'cash': 'hotel_calendar_cash_bench', 'points': 'hotel_calendar_bench'}
+sort_column = '_id'
+sort_order = -1
+dedupe_fields = [
+    ['_id'],
+    ['hotel_id', 'created_date', 'date']
+]
+
+script_filename = os.path.basename(os.path.abspath(__file__))
+
+def synthetic_documents(table_type, n_docs, seed=0, start_datetime=datetime(2023, 10, 1), n_hotels=300):
+    # Scrape-like documents in _id (= created_at) order: nested cash_value dicts, string dates, repeat scrapes of the
+    # same hotel/date on one day (duplicates), malformed rows, and points rows mixed into the cash tables
+    rng = random.Random(seed)
+    award_categories = ['standard', 'premium', 'suite']
+    seconds_per_doc = 7 * 24 * 3600 / n_docs # spread the documents over a week of scraping
+    for i in range(n_docs):
+        created_at = start_datetime + timedelta(seconds=int(i * seconds_per_doc))
+        hotel_n = rng.randrange(n_hotels)
+        document = {
+            # Timestamp bytes from created_at like a real insert, document number in the rest so same-second _ids stay unique
+            '_id': ObjectId(str(ObjectId.from_datetime(created_at))[:8] + format(i, '016x')),
+            'hotel_group': 'bench',
+            'hotel_name': f'Hotel {hotel_n} New York',
+            'hotel_name_key': f'hotel-{hotel_n}-new-york',
+            'hotel_id': str(hotel_n),
+            'city': 'new-york',
+            'award_category': rng.choice(award_categories),
+            'created_at': created_at,
+            'date': (created_at + timedelta(days=rng.randrange(1, 8))).strftime('%Y-%m-%d'), # few dates, so many duplicates
+            'url': f'https://example.com/hotels/{hotel_n}?date={i}',
+            'room_types': [{'name': 'King', 'beds': 1}, {'name': 'Double Queen', 'beds': 2}], # unprojected payload
+        }
+
+        roll = rng.random()
+        if roll < 0.02:
+            document['date'] = rng.choice(['', 'N/A', '2023-13-45']) # malformed date
+        if table_type == 'cash':
+            if roll > 0.95:
+                document['points'] = rng.randrange(5000, 80000) # points row mixed into a cash table
+                document['points_level'] = 'standard'
+            elif roll > 0.92:
+                document['cash_value'] = rng.choice([None, 0, 'sold out']) # malformed cash_value
+            else:
+                amount = round(rng.uniform(80, 900), 2)
+                document['cash_value'] = {'amount': str(amount) if rng.random() < 0.3 else amount, 'currency': 'USD' if rng.random() < 0.9 else 'EUR'}
+        else:
+            document['points'] = rng.randrange(5000, 80000) if roll < 0.9 else None
+            document['points_level'] = rng.choice(['standard', 'premium'])
+        yield document
+
+def load_documents(collection, documents, batch_size=10000):
+    # Replace the collection's contents with documents, returning the total BSON size in bytes
+    collection.drop()
+    total_bytes = 0
+    batch = []
+    for document in documents:
+        total_bytes += len(bson.encode(document))
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    return total_bytes
+
+class StageMeter:
+    # Accumulates seconds, docs and bytes per pipeline stage, while a sampler thread tracks each stage's peak RSS
+    def __init__(self, sample_seconds=0.01):
+        self.totals = {}
+        self.current_stage = None
+        self.sample_seconds = sample_seconds
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stop_event.wait(self.sample_seconds):
+            stage = self.current_stage
+            if stage is not None:
+                self.totals[stage]['peak_rss_mb'] = max(self.totals[stage]['peak_rss_mb'], current_rss_mb())
+
+    @contextmanager
+    def stage(self, name):
+        stage_totals = self.totals.setdefault(name, {'seconds': 0.0, 'docs': 0, 'bytes': 0, 'peak_rss_mb': 0.0})
+        self.current_stage = name
+        stage_totals['peak_rss_mb'] = max(stage_totals['peak_rss_mb'], current_rss_mb())
+        start_time = time.perf_counter()
+        try:
+            yield stage_totals
+        finally:
+            stage_totals['seconds'] += time.perf_counter() - start_time
+            stage_totals['peak_rss_mb'] = max(stage_totals['peak_rss_mb'], current_rss_mb())
+            self.current_stage = None
+
+    def close(self):
+        self.stop_event.set()
+        self.sampler.join()
+
+def benchmark_chunk_size(session, table_type, input_table, output_table, columns_dict, chunk_size, load_method, pushdown, compact_dtypes, bytes_per_doc, logger):
+    # Extract the whole benchmark collection in chunks of chunk_size, timing fetch, clean and load separately
+    postgres_conn = session.postgres
+    with postgres_conn.engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {output_table}')
+    column_order = postgres_conn.create_table(output_table, columns_dict, logger)
+    projection = projection_cash_points(columns_dict)
+    dtypes = dtypes_cash_points(columns_dict) if compact_dtypes else None
+    dedupe_index = DedupeIndex(dedupe_fields[-1])
+
+    meter = StageMeter()
+    start_id = None
+    chunk_n = 0
+    try:
+        while True:
+            with meter.stage('fetch') as totals:
+                query = query_cash_points(input_table, start_id)
+                pipeline = pipeline_cash_points(table_type, query, projection, sort_column, sort_order, chunk_size) if pushdown else None
+                df = session.extract(input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, projection, pipeline, dedupe_index, dtypes)
+                if df is None or df.attrs.get('fetched_count', len(df)) == 0:
+                    break
+                totals['docs'] += df.attrs['fetched_count']
+                totals['bytes'] += df.attrs['fetched_count'] * bytes_per_doc # BSON shipped from Mongo, estimated from the collection's average
+
+            start_id = df.attrs['last_id']
+            if df.empty:
+                chunk_n += 1
+                continue
+
+            with meter.stage('clean') as totals:
+                totals['bytes'] += frame_bytes(df)
+                clean = clean_cash if table_type == 'cash' else clean_points
+                clean_df = clean(df, column_order, logger, flattened=pushdown, dtypes=dtypes)
+                totals['docs'] += len(df)
+
+            if clean_df is None or clean_df.empty:
+                chunk_n += 1
+                continue
+
+            with meter.stage('load') as totals:
+                helper_columns = {'run_id': 'benchmark', 'hotel_group': 'bench', 'input_table': input_table, 'chunk_n': chunk_n, 'extract_dt': datetime.utcnow()}
+                if postgres_conn.insert_postgres(clean_df, output_table, logger, helper_columns, column_order, load_method, dtypes) is None:
+                    raise RuntimeError(f'Loading chunk {chunk_n} into {output_table} failed')
+                totals['docs'] += len(clean_df)
+                totals['bytes'] += frame_bytes(clean_df)
+            chunk_n += 1
+    finally:
+        meter.close()
+
+    results = []
+    for stage, totals in meter.totals.items():
+        seconds = max(totals['seconds'], 1e-9)
+        results.append({
+            'table_type': table_type, 'chunk_size': chunk_size, 'stage': stage, 'chunks': chunk_n, 'docs': totals['docs'],
+            'seconds': round(totals['seconds'], 3), 'docs_per_sec': round(totals['docs'] / seconds),
+            'mb': round(totals['bytes'] / 1024 ** 2, 1), 'mb_per_sec': round(totals['bytes'] / 1024 ** 2 / seconds, 1),
+            'peak_rss_mb': round(totals['peak_rss_mb'], 1),
+        })
+    return results
+
+def main(n_docs, chunk_sizes, table_types, mongo_uri=None, postgres_uri=None, pushdown=False, compact_dtypes=True, seed=0, output_csv=None):
+    logger = log_config(script_filename)
+
+    # SQLite has no COPY, so only use the copy load method against a real Postgres
+    load_method = 'copy' if postgres_uri else 'to_sql'
+    os.environ['POSTGRESQL_URI'] = postgres_uri or 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'odynn_benchmark.db') # outside the source tree
+
+    mongo_client = None
+    if mongo_uri:
+        os.environ['BENCHMARK_MONGO_URI'] = mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            logger.error('mongomock is needed for the in-process benchmark (pip install mongomock), or pass --mongo_uri of a local mongod')
+            return
+        if pushdown:
+            logger.error('mongomock does not support the pushdown pipeline ($convert), pass --mongo_uri of a local mongod')
+            return
+        mongo_client = mongomock.MongoClient()
+
+    logger.info(f'STARTING BENCHMARK n_docs={n_docs} chunk_sizes={chunk_sizes} table_types={table_types} pushdown={pushdown} compact_dtypes={compact_dtypes} load_method={load_method}')
+    results = []
+    with ExtractionSession('BENCHMARK_MONGO_URI', benchmark_database, mongo_client=mongo_client) as session:
+        for table_type in table_types:
+            input_table = benchmark_tables[table_type]
+            columns_dict = input_output_dict[table_type]['output_table']['table_columns']
+            output_table = f"bench_{input_output_dict[table_type]['output_table']['table_name']}"
+
+            start_time = time.perf_counter()
+            total_bytes = load_documents(session.collection(input_table), synthetic_documents(table_type, n_docs, seed))
+            logger.info(f'Generated {n_docs} {table_type} documents ({total_bytes / 1024 ** 2:.1f} MB BSON) in {time.perf_counter() - start_time:.1f}s')
+
+            for chunk_size in chunk_sizes:
+                try:
+                    chunk_results = benchmark_chunk_size(session, table_type, input_table, output_table, columns_dict, chunk_size, load_method, pushdown, compact_dtypes, total_bytes / n_docs, logger)
+                except Exception as e:
+                    logger.error(f'Benchmark of {table_type} at chunk_size = {chunk_size} failed. {e}')
+                    logger.error({traceback.format_exc()})
+                    continue
+                for result in chunk_results:
+                    logger.info(' '.join(f'{key}={value}' for key, value in result.items()))
+                results.extend(chunk_results)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string(index=False))
+    if output_csv:
+        results_df.to_csv(output_csv, index=False)
+    return results_df
+
+# python odynn_extract/benchmark_pipeline.py
+# python odynn_extract/benchmark_pipeline.py --docs 500000 --chunk_sizes 50000 200000 1000000 --output_csv before.csv
+# python odynn_extract/benchmark_pipeline.py --mongo_uri mongodb://localhost:27017 --postgres_uri postgresql://localhost/bench --pushdown
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extract -> clean -> load on synthetic documents")
+    parser.add_argument("--docs", help="Synthetic documents per table type", type=int, default=100000)
+    parser.add_argument("--chunk_sizes", help="Chunk sizes to benchmark", type=int, nargs='+', default=[10000, 50000, 100000])
+    parser.add_argument("--table_types", help="Table types to benchmark", nargs='+', choices=list(benchmark_tables), default=list(benchmark_tables))
+    parser.add_argument("--mongo_uri", help="Local mongod to benchmark against instead of in-process mongomock", default=None)
+    parser.add_argument("--postgres_uri", help="Local Postgres to load into instead of a SQLite file", default=None)
+    parser.add_argument("--pushdown", help="Filter, flatten and parse chunks in a Mongo aggregation pipeline (needs --mongo_uri)", action="store_true")
+    parser.add_argument("--object_dtypes", help="Keep chunks in plain object/int64 dtypes instead of the compact dtype schema", action="store_true")
+    parser.add_argument("--seed", help="Random seed for the synthetic documents", type=int, default=0)
+    parser.add_argument("--output_csv", help="Also write the results to this CSV, to compare runs", default=None)
+    args = parser.parse_args()
+
+    main(args.docs, args.chunk_sizes, args.table_types, args.mongo_uri, args.postgres_uri, args.pushdown, not args.object_dtypes, args.seed, args.output_csv)
@@ -1,112 +1,464 @@
 import os
+import time
 import argparse
 import traceback
 import pandas as pd
-from datetime import datetime
-
-from utils.settings_cash_points import input_output_dict, query_cash_points, clean_cash, clean_points
-from utils.table_utils import PostgresInserter, extract_mongodb
-from log.log_config import log_config
-
-# Main function
-def main(prefix, chunk_cap):
-    env_str = "OUTPUT_MONGO_URI"  # Input table URI (Forbes sample)
-    chunk_size = 1000000 #previously 500k
-    mongo_database = 'awayzDB'
-    sort_column = '_id'
-    sort_order = -1
-    dedupe_fields = [
-        ['_id'],
-        ['hotel_id', 'created_date', 'date']
-    ]
-
-    script_filename = os.path.basename(os.path.abspath(__file__))
-    run_name = os.path.splitext(script_filename)[0]
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from utils.settings_cash_points import input_output_dict, query_cash_points, projection_cash_points, dtypes_cash_points, pipeline_cash_points, clean_cash, clean_points
+from utils.table_utils import ExtractionSession, PostgresInserter, DedupeIndex, ChunkSizer, run_pipelined, add_helper_columns, frame_bytes
+from utils.spool_utils import write_spool_chunk, remove_spool_files, remove_unloaded_spool_chunks
+from utils.id_utils import plan_id_ranges, id_range_query, next_object_id, date_id_range, boundary_cache_collection
+from log.log_config import log_config, worker_logger
+
+env_str = "OUTPUT_MONGO_URI"  # Input table URI (Forbes sample)
+chunk_size = 1000000 #previously 500k. Starting size when chunks are sized adaptively (--memory_budget_mb / --target_chunk_seconds)
+mongo_database = 'awayzDB'
+sort_column = '_id'
+sort_order = -1
+dedupe_fields = [
+    ['_id'],
+    ['hotel_id', 'created_date', 'date']
+]
+# With --latest_per_day only the latest cleaned row per hotel, award_category, stay date and created day is kept, like
+# the row_number() ... rn = 1 of odynn_transform/data_sample.sql. hotel_group is fixed per input_table, and the
+# _id-descending scan sees each key's latest document first
+latest_per_day_fields = ['hotel_name_key', 'award_category', 'date', 'created_date']
+
+def keep_latest_per_day(df, latest_index):
+    # Drop rows whose key was already kept, in this chunk or an earlier one of the range
+    df = latest_index.drop_seen(df.assign(created_date=df['created_at'].dt.normalize()))
+    return df.drop(columns=['created_date'])
+
+script_filename = os.path.basename(os.path.abspath(__file__))
+run_name = os.path.splitext(script_filename)[0]
+
+# Key columns of the run_checkpoint row of one [lower_id, upper_id) range of an input_table
+def range_checkpoint(prefix, input_table, lower_id, upper_id, run_id):
+    return {
+        'run_name': run_name, 'prefix': prefix, 'input_table': input_table,
+        'range_key': f"{lower_id or ''}-{upper_id or ''}",
+        'lower_id': str(lower_id) if lower_id is not None else None,
+        'upper_id': str(upper_id) if upper_id is not None else None,
+        'run_id': run_id,
+    }
+
+# Extract -> clean -> load one [lower_id, upper_id) range of an input_table, scanning _id downward from upper_id.
+# Runs in the main process, or as one task of the worker pool. A checkpoint dict resumes after its last committed chunk
+def extract_table(table_type, input_table, output_table, column_order, load_method, run_id, chunk_cap, prefix,
+                  lower_id=None, upper_id=None, worker_name=None, checkpoint=None, projection=None, dtypes=None, partition=None, merge_keys=None, pushdown=False,
+                  cross_chunk_dedupe=True, dedupe_bloom_mb=None, pipeline_depth=0, memory_budget_mb=None, target_chunk_seconds=None,
+                  spool_dir=None, spool_only=False, latest_per_day=False, shared_workers=1):
+    logger = worker_logger(log_config(script_filename), worker_name or input_table) # re-configured here so process workers log too
+
+    # One session per worker: pool_size=1 bounds concurrent Mongo and Postgres connections to the number of workers
+    with ExtractionSession(env_str, mongo_database, pool_size=1) as session:
+        postgres_conn = session.postgres
+
+        min_query = id_range_query(lower_id, upper_id)
+        min_id = session.extract(input_table, min_query, 1, sort_column, 1, None, logger)
+
+        if min_id is None:
+            return 0
+
+        if min_id.empty:
+            logger.info(f"No documents in {input_table} for min_query = {min_query}")
+            # Nothing to extract still counts as done, e.g. for publishing a staging table
+            postgres_conn.save_checkpoint({**range_checkpoint(prefix, input_table, lower_id, upper_id, run_id),
+                                           'start_id': None, 'chunk_n': 0, 'rows_inserted': 0, 'completed': True}, logger)
+            return 0
+
+        min_id = min_id.iloc[0][sort_column]
+        logger.info(f"min_id = {min_id} for {input_table}. min_query = {min_query}")
+
+        start_id = upper_id
+        chunk_n = 0
+        rows_inserted = 0
+        hotel_group = input_table.split('_')[-1]
+
+        if checkpoint is not None and checkpoint['start_id'] is not None:
+            start_id = ObjectId(checkpoint['start_id'])
+            chunk_n = checkpoint['chunk_n']
+            rows_inserted = checkpoint['rows_inserted']
+            logger.info(f'Resuming {input_table} from checkpoint start_id = {start_id}, chunk_n = {chunk_n}, rows_inserted = {rows_inserted}')
+        if spool_dir and checkpoint is not None and checkpoint['run_id'] != run_id:
+            # Chunks an earlier run spooled below its last committed chunk are extracted and spooled again
+            remove_unloaded_spool_chunks(spool_dir, output_table, input_table, lower_id, start_id, logger)
+
+        # Drop duplicates across every chunk of this range, not just within each chunk
+        bloom_bits = int(dedupe_bloom_mb * 8 * 1024 * 1024) if dedupe_bloom_mb else None
+        task_dedupe_fields = dedupe_fields
+        dedupe_index = None
+        latest_index = None
+        if latest_per_day:
+            # Collapsed after cleaning instead, so an invalid latest document can't shadow the valid one before it. Only spans
+            # the chunks of this run: after a --resume, keys kept before the interruption can be kept again
+            task_dedupe_fields = dedupe_fields[:1]
+            latest_index = DedupeIndex(latest_per_day_fields, bloom_bits=bloom_bits)
+        elif cross_chunk_dedupe:
+            dedupe_index = DedupeIndex(dedupe_fields[-1], bloom_bits=bloom_bits)
+
+        # Chunks queued between pipelined stages count against the memory budget too
+        chunks_in_flight = 2 * pipeline_depth + 3 if pipeline_depth else 1
+        chunk_sizer = ChunkSizer(chunk_size, logger, memory_budget_mb, target_chunk_seconds, chunks_in_flight, shared_workers=shared_workers)
+        
+        checkpoint = range_checkpoint(prefix, input_table, lower_id, upper_id, run_id)
+
+        # Stage 1: fetch chunks downward from start_id until min_id, chunk_cap, or an error
+        def fetch_chunks():
+            nonlocal fully_fetched
+            fetch_id = start_id
+            fetch_n = chunk_n
+            while chunk_cap is None or fetch_n < chunk_cap:
+                if fetch_id is not None and fetch_id <= min_id:
+                    logger.info(f'Reached minimum _id {min_id}. Exiting loop.\n')
+                    fully_fetched = True
+                    return
+
+                extract_dt = datetime.utcnow()
+                fetch_start = time.perf_counter()
+                query = query_cash_points(input_table, fetch_id, lower_id)
+                limit = chunk_sizer.next_size()
+                # With pushdown Mongo filters, flattens and parses each chunk, so only valid flat rows are shipped
+                pipeline = pipeline_cash_points(table_type, query, projection, sort_column, sort_order, limit) if pushdown else None
+                df = session.extract(input_table, query, limit, sort_column, sort_order, task_dedupe_fields, logger, projection, pipeline, dedupe_index, dtypes)
+
+                if df is None:
+                    logger.error(f'df empty or none')
+                    return
+                elif df.attrs.get('fetched_count', len(df)) == 0:
+                    logger.info(f'No documents left below {fetch_id}. Exiting loop.\n')
+                    fully_fetched = True
+                    return
+                elif df.empty:
+                    # Every document of this chunk was a duplicate of an earlier chunk, so skip past it
+                    fetch_id = df.attrs['last_id']
+                    continue
+                elif sort_column not in df.columns:
+                    logger.error(f'df missing sort_column = {sort_column} {df.columns} {df}')
+                    return
+
+                prior_id = fetch_id
+                fetch_id = df.attrs.get('last_id', df.iloc[-1][sort_column]) # last _id fetched, even if deduped away
+                metrics = {
+                    'run_id': run_id, 'run_name': run_name, 'input_table': input_table, 'output_table': output_table,
+                    'worker_name': worker_name or input_table, 'chunk_n': fetch_n,
+                    'min_id': str(fetch_id), 'max_id': str(df.attrs.get('first_id', df.iloc[0][sort_column])),
+                    'docs_fetched': df.attrs.get('fetched_count', len(df)), 'rows_after_dedupe': len(df),
+                    'fetched_bytes': frame_bytes(df), 'fetch_seconds': time.perf_counter() - fetch_start,
+                }
+                yield {'chunk_n': fetch_n, 'prior_id': prior_id, 'start_id': fetch_id, 'extract_dt': extract_dt, 'df': df, 'metrics': metrics}
+                fetch_n += 1
+
+        # Stage 2: clean
+        def clean_chunk(chunk):
+            clean_start = time.perf_counter()
+            df = chunk.pop('df')
+            if table_type == 'cash':
+                chunk['clean_df'] = clean_cash(df, column_order, logger, flattened=pushdown, dtypes=dtypes)
+            else:
+                chunk['clean_df'] = clean_points(df, column_order, logger, flattened=pushdown, dtypes=dtypes)
+            if latest_index is not None and chunk['clean_df'] is not None:
+                initial_row_count = len(chunk['clean_df'])
+                chunk['clean_df'] = keep_latest_per_day(chunk['clean_df'], latest_index)
+                logger.info(f"Kept {len(chunk['clean_df'])} of {initial_row_count} rows, the latest per {latest_per_day_fields}")
+            chunk['metrics']['clean_seconds'] = time.perf_counter() - clean_start
+            return chunk
+
+        # Stage 3: load and checkpoint. Returns False to stop the range
+        def load_chunk(chunk):
+            nonlocal chunk_n, rows_inserted, loaded_id, docs_fetched
+            clean_df = chunk['clean_df']
+            # None is a cleaning error. A chunk without valid rows, or collapsed away entirely, still moves the checkpoint on
+            if clean_df is None:
+                logger.error(f"Stopping {input_table} at chunk {chunk['chunk_n']}, resume from checkpoint start_id = {chunk['prior_id']}")
+                return False
+
+            load_start = time.perf_counter()
+            helper_columns = {'run_id': run_id, 'hotel_group': hotel_group, 'input_table': input_table,'chunk_n': chunk['chunk_n'], 'extract_dt': chunk['extract_dt']}
+            load_df = add_helper_columns(clean_df, helper_columns, dtypes)
+
+            # Spool before loading, so every chunk in Postgres can be replayed from the spool (see replay_spool.py)
+            spool_paths = []
+            if spool_dir and not load_df.empty:
+                spool_metadata = {'output_table': output_table, 'run_id': run_id, 'input_table': input_table, 'chunk_n': chunk['chunk_n'],
+                                  'min_id': chunk['metrics']['min_id'], 'max_id': chunk['metrics']['max_id']}
+                try:
+                    spool_paths = write_spool_chunk(load_df[column_order], spool_dir, output_table, spool_metadata, logger)
+                except Exception as e:
+                    logger.error(f"Error spooling chunk {chunk['chunk_n']} of {input_table} to {spool_dir}, resume from checkpoint start_id = {chunk['prior_id']}. {e}")
+                    return False
+
+            if spool_only or load_df.empty:
+                inserted_count = len(load_df)
+            else:
+                inserted_count = postgres_conn.insert_postgres(load_df, output_table, logger, None, column_order, load_method, dtypes, partition, merge_keys)
+            if inserted_count is None:
+                logger.error(f"Stopping {input_table} at chunk {chunk['chunk_n']}, resume from checkpoint start_id = {chunk['prior_id']}")
+                # The resumed run spools this chunk again, so its files would be replayed twice
+                remove_spool_files(spool_paths, logger)
+                return False
+            load_seconds = time.perf_counter() - load_start
+
+            rows_inserted += len(clean_df)
+            docs_fetched += chunk['metrics']['docs_fetched']
+            chunk_n = chunk['chunk_n'] + 1
+            loaded_id = chunk['start_id']
+            metrics = chunk['metrics']
+            chunk_sizer.observe(metrics['docs_fetched'], metrics['fetched_bytes'], metrics['fetch_seconds'] + metrics['clean_seconds'] + load_seconds)
+            logger.info(f"From {input_table} queried {docs_fetched}, inserted {rows_inserted} from {chunk['prior_id']} - {loaded_id}")
+
+            # Record the committed position so --resume can pick up after this chunk
+            postgres_conn.save_checkpoint({**checkpoint, 'start_id': str(loaded_id), 'chunk_n': chunk_n, 'rows_inserted': rows_inserted, 'completed': False}, logger)
+            postgres_conn.save_chunk_metrics(prefix, {**chunk['metrics'], 'rows_cleaned': len(clean_df), 'rows_inserted': inserted_count,
+                                                      'cleaned_bytes': frame_bytes(clean_df), 'load_seconds': load_seconds}, logger)
+            return True
+
+        fully_fetched = False
+        loaded_id = start_id
+        docs_fetched = 0
+        try:
+            if pipeline_depth:
+                # Fetch and clean chunk N+1 while chunk N loads, with at most pipeline_depth chunks queued per stage
+                all_loaded = run_pipelined(fetch_chunks(), clean_chunk, load_chunk, pipeline_depth, logger)
+            else:
+                all_loaded = True
+                for chunk in fetch_chunks():
+                    if not load_chunk(clean_chunk(chunk)):
+                        all_loaded = False
+                        break
+
+            if fully_fetched and all_loaded:
+                postgres_conn.save_checkpoint({**checkpoint, 'start_id': str(loaded_id) if loaded_id is not None else None, 'chunk_n': chunk_n, 'rows_inserted': rows_inserted, 'completed': True}, logger)
+
+        except Exception as e:
+            logger.error(f"Error piping data from {input_table} into {output_table}. {e} ")
+            logger.error({traceback.format_exc()})
+
+    return rows_inserted
+
+def publish_staged_tables(prefix, staged_tables, logger):
+    # Swap each staging table in for its output table, once every _id range planned for its input_tables has a completed
+    # checkpoint. Checked against the planned ranges, so a range whose checkpoint row is missing also holds it back
+    with PostgresInserter() as postgres_conn:
+        for output_table, staged in staged_tables.items():
+            completed = {(input_table, checkpoint['range_key']): checkpoint['completed'] for input_table in staged['planned_ranges']
+                         for checkpoint in postgres_conn.load_checkpoints(run_name, prefix, input_table, logger)}
+            planned = [(input_table, range_key) for input_table, range_keys in staged['planned_ranges'].items() for range_key in range_keys]
+            if not planned or not all(completed.get(planned_range) for planned_range in planned):
+                logger.warning(f"Not publishing {output_table}: some input_tables did not finish. Rerun with --resume to finish loading and publish it")
+                continue
+            postgres_conn.publish_staging_table(output_table, logger, staged['indexes'])
+
+# Main function. extract_options (pushdown, pipeline_depth, ...) are passed through to every extract_table task.
+# load_mode 'append' loads straight into the output tables; 'staging' loads each into an UNLOGGED staging table
+# and swaps it in once every input_table is done, replacing the output table's contents; 'merge' upserts each chunk
+# on _id, so rerun chunks and overlapping ranges update rows instead of duplicating them
+def main(prefix, chunk_cap, workers=1, worker_type='process', slices=1, resume=False, incremental=False, start_date=None, end_date=None,
+         load_mode='append', id_slack_hours=1, **extract_options):
     logger = log_config(script_filename)  # Configure the logger
-    
+    if extract_options.get('spool_only') and not extract_options.get('spool_dir'):
+        logger.error('--spool_only needs --spool_dir, otherwise chunks would be neither spooled nor loaded')
+        return
+    if load_mode == 'staging' and (incremental or start_date or end_date or extract_options.get('spool_only')):
+        logger.error('--load_mode staging replaces the output tables with everything extracted, so it cannot be combined with '
+                     '--incremental, --start_date/--end_date or --spool_only')
+        return
+
     run_id = None
     try:
-        with PostgresInserter() as postgres_conn:
-            run_details = f'chunk_cap = {chunk_cap}, chunk_size = {chunk_size}'
+        with ExtractionSession(env_str, mongo_database) as session:
+            postgres_conn = session.postgres
+            run_options = {'chunk_cap': chunk_cap, 'chunk_size': chunk_size, 'workers': workers, 'worker_type': worker_type,
+                           'slices': slices, 'resume': resume, 'incremental': incremental, 'start_date': start_date, 'end_date': end_date, 'load_mode': load_mode, 'id_slack_hours': id_slack_hours, **extract_options}
+            run_details = ', '.join(f'{option} = {value}' for option, value in run_options.items())
             run_id = postgres_conn.start_run(run_name, prefix, logger, details=run_details)
-            logger.info(f'\nStarting run #{run_id}. prefix={prefix} chunk_size={chunk_size} chunk_cap={chunk_cap}')
+            postgres_conn.create_checkpoint_table(prefix, logger)
+            postgres_conn.create_chunk_metrics_table(prefix, logger)
+            logger.info(f'\nStarting run #{run_id}. prefix={prefix} ' + ' '.join(f'{option}={value}' for option, value in run_options.items()))
     except Exception as e:
         logger.error(f'Error starting run. {e}')
         logger.error({traceback.format_exc()})
         return
 
+    # Create output tables up front, then queue one task per input_table _id range
+    tasks = []
+    staged_tables = {}
+    session = ExtractionSession(env_str, mongo_database)
+    postgres_conn = session.postgres
     for table_type, table_type_dict in input_output_dict.items():
         output_table = f"{prefix}{table_type_dict['output_table']['table_name']}"
         columns_dict = table_type_dict['output_table']['table_columns']
-        
+        load_method = table_type_dict['output_table'].get('load_method', 'to_sql')
+        partition = table_type_dict['output_table'].get('partition')
+        projection = projection_cash_points(columns_dict) # only fetch fields the output table keeps
+        dtypes = dtypes_cash_points(columns_dict) # compact in-memory dtypes for every chunk
+
+        load_table = output_table
+        merge_keys = None
         try:
-            with PostgresInserter() as postgres_conn:
-                column_order = postgres_conn.create_table(output_table, columns_dict, logger)
+            if load_mode == 'staging':
+                # On --resume keep loading the staging table the interrupted run left behind
+                load_table, column_order = postgres_conn.create_staging_table(output_table, columns_dict, logger, partition, keep_existing=resume)
+                staged_tables[output_table] = {'planned_ranges': {}, 'indexes': table_type_dict['output_table'].get('indexes')}
+            else:
+                column_order = postgres_conn.create_table(output_table, columns_dict, logger, partition=partition)
+            if load_mode == 'merge' and column_order is not None:
+                merge_keys = postgres_conn.merge_key_columns(output_table, partition)
+                if not postgres_conn.create_merge_index(output_table, merge_keys, logger):
+                    continue
         except Exception as e:
             logger.error(f"Error creating {output_table} with columns_dict:\n{columns_dict}\n{e}")
             logger.error({traceback.format_exc()})
             continue
 
         for input_table in table_type_dict['input_tables']:
-            min_query = {}
-            min_id = extract_mongodb(mongo_database, input_table, min_query, 1, sort_column, 1, None, logger, env_str)
-            
-            if min_id is None:
-                continue
-            
-            if not min_id.empty:
-                min_id = min_id.iloc[0][sort_column]
-                logger.info(f"min_id = {min_id} for {input_table}. min_query = {min_query}")
-            
-            start_id = None
-            chunk_n = 0
-            rows_inserted = 0
-            hotel_group = input_table.split('_')[-1]
-            
-            try:
-                while chunk_cap is None or chunk_n < chunk_cap:
-                    if start_id is not None and start_id <= min_id:
-                        logger.info(f'Reached minimum _id {min_id}. Exiting loop.\n')
-                        break
-                    
-                    extract_dt = datetime.utcnow()
-                    query = query_cash_points(input_table, start_id)
-                    df = extract_mongodb(mongo_database, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, env_str)
-                    
-                    if df is None or df.empty:
-                        logger.error(f'df empty or none')
-                        break
-                    elif sort_column not in df.columns:
-                        logger.error(f'df missing sort_column = {sort_column} {df.columns} {df}')
-                        break
-                    
-                    prior_id = start_id
-                    start_id = df.iloc[-1][sort_column]
-                    
-                    helper_columns = {'run_id': run_id, 'hotel_group': hotel_group, 'input_table': input_table,'chunk_n': chunk_n, 'extract_dt': extract_dt}
-                    if table_type == 'cash':
-                        clean_df = clean_cash(df, column_order, logger)
-                    else:
-                        clean_df = clean_points(df, column_order, logger)
-                    
-                    if clean_df is None or clean_df.empty:
-                        break
-                    
-                    postgres_conn.insert_postgres(clean_df, output_table, logger, helper_columns, column_order)
-                    
-                    rows_inserted += len(clean_df)
-                    chunk_n += 1
-                    logger.info(f'From {input_table} queried {chunk_size * chunk_n}, inserted {rows_inserted} from {prior_id} - {start_id}')
-        
-            except Exception as e:
-                logger.error(f"Error piping data from {input_table} into {output_table}. {e} ")
-                logger.error({traceback.format_exc()})
+            # On --resume reuse the saved _id ranges (sampling would plan different ones), otherwise start fresh
+            # With --incremental only extract documents above the highest _id already loaded from input_table
+            checkpoints = postgres_conn.load_checkpoints(run_name, prefix, input_table, logger) if resume or incremental else []
+            max_loaded_id = postgres_conn.get_max_id(output_table, input_table, logger) if incremental else None
+            lower_id = next_object_id(max_loaded_id) if max_loaded_id else None
+
+            # Ranges are scanned downward, so an interrupted or --chunk_cap'd run leaves a gap below max(_id). Without
+            # --resume, --incremental still finishes those unfinished ranges, from their checkpoints, next to the new range
+            pending_checkpoints = []
+            if incremental and not resume:
+                if max_loaded_id:
+                    pending_checkpoints = [c for c in checkpoints if not c['completed']]
+                checkpoints = []
+                postgres_conn.clear_checkpoints(run_name, prefix, input_table, logger, completed_only=bool(pending_checkpoints))
+            elif not checkpoints:
+                postgres_conn.clear_checkpoints(run_name, prefix, input_table, logger)
+            upper_id = None
+            if incremental:
+                logger.info(f'Incremental extract of {input_table} above max loaded _id = {max_loaded_id}')
+
+            if start_date or end_date:
+                # Narrow to documents created in [start_date, end_date), using the cached created_at -> _id boundaries
+                try:
+                    date_min_id, date_max_id, date_count = date_id_range(session.collection(input_table), session.collection(boundary_cache_collection),
+                                                                         start_date or datetime(2000, 1, 1), end_date or datetime.utcnow(), logger,
+                                                                         timedelta(hours=id_slack_hours))
+                except Exception as e:
+                    logger.error(f"Error looking up _id range of {start_date} - {end_date} for {input_table}, skipping it. {e}")
+                    continue
+                if not date_count:
+                    continue
+                lower_id = max(lower_id, date_min_id) if lower_id else date_min_id
+                upper_id = next_object_id(date_max_id)
+
+            if checkpoints:
+                id_ranges = [(ObjectId(c['lower_id']) if c['lower_id'] else None, ObjectId(c['upper_id']) if c['upper_id'] else None) for c in checkpoints]
+            else:
+                try:
+                    # Both dedupe keys include the created day, so day-aligned slices keep each key within one worker's dedupe index.
+                    # The trade-off is fewer slices than asked when the range spans fewer days, which plan_id_ranges warns about
+                    align_days = extract_options.get('cross_chunk_dedupe', True) or extract_options.get('latest_per_day', False)
+                    id_ranges = plan_id_ranges(session.collection(input_table), slices, logger, lower_id=lower_id, upper_id=upper_id,
+                                               align_days=align_days)
+                except Exception as e:
+                    logger.error(f"Error planning _id ranges for {input_table}, extracting it unsliced. {e}")
+                    id_ranges = [(lower_id, upper_id)]
+                # Saved before any task starts, so --resume finds every planned range, including those that never committed a chunk
+                checkpoints = [{**range_checkpoint(prefix, input_table, range_lower_id, range_upper_id, run_id),
+                                'start_id': None, 'chunk_n': 0, 'rows_inserted': 0, 'completed': False} for range_lower_id, range_upper_id in id_ranges]
+                for checkpoint in checkpoints:
+                    postgres_conn.save_checkpoint(checkpoint, logger)
+
+            if pending_checkpoints:
+                logger.info(f'Finishing {len(pending_checkpoints)} unfinished _id ranges of {input_table} from earlier runs')
+                for c in pending_checkpoints:
+                    id_ranges.append((ObjectId(c['lower_id']) if c['lower_id'] else None, ObjectId(c['upper_id']) if c['upper_id'] else None))
+                    # A range that never committed a chunk stops below the new range, which covers the _ids above max(_id)
+                    start_id = c['start_id']
+                    if start_id is None and lower_id and (not c['upper_id'] or ObjectId(c['upper_id']) > lower_id):
+                        start_id = str(lower_id)
+                    checkpoints.append({**c, 'start_id': start_id})
+
+            if output_table in staged_tables:
+                staged_tables[output_table]['planned_ranges'][input_table] = [checkpoint['range_key'] for checkpoint in checkpoints]
+
+            for slice_n, ((lower_id, upper_id), checkpoint) in enumerate(zip(id_ranges, checkpoints)):
+                worker_name = f'{input_table}[{slice_n}]' if len(id_ranges) > 1 else input_table
+                if checkpoint is not None and checkpoint['completed']:
+                    logger.info(f'Skipping {worker_name}, already completed per checkpoint')
+                    continue
+                if checkpoint['run_id'] != run_id:
+                    # Taken over by this run before it loads any rows, so transform_clean_tables.py keeps this run open until it's done
+                    postgres_conn.save_checkpoint({**checkpoint, 'run_id': run_id}, logger)
+                tasks.append({
+                    'table_type': table_type, 'input_table': input_table, 'output_table': load_table,
+                    'column_order': column_order, 'load_method': load_method, 'run_id': run_id, 'chunk_cap': chunk_cap,
+                    'prefix': prefix, 'lower_id': lower_id, 'upper_id': upper_id, 'worker_name': worker_name, 'checkpoint': checkpoint,
+                    'projection': projection, 'dtypes': dtypes, 'partition': partition, 'merge_keys': merge_keys, **extract_options,
+                })
+    session.close()
+
+    if workers <= 1:
+        for task in tasks:
+            extract_table(**task)
+    else:
+        # Each worker holds at most one Mongo and one Postgres connection at a time, so workers bounds both
+        executor_class = ProcessPoolExecutor if worker_type == 'process' else ThreadPoolExecutor
+        if worker_type == 'thread':
+            # Thread workers share one process, and so its --memory_budget_mb
+            for task in tasks:
+                task['shared_workers'] = workers
+        with executor_class(max_workers=workers) as executor:
+            futures = {executor.submit(extract_table, **task): task['worker_name'] for task in tasks}
+            for future in as_completed(futures):
+                worker_name = futures[future]
+                try:
+                    logger.info(f'Worker finished {worker_name}, inserted {future.result()} rows')
+                except Exception as e:
+                    logger.error(f'Worker failed on {worker_name}. {e}')
+                    logger.error({traceback.format_exc()})
+
+    if staged_tables:
+        publish_staged_tables(prefix, staged_tables, logger)
 
-# python odynn_extract/extract_cash_points.py --prefix test_ --chunk_cap 2            
+# python odynn_extract/extract_cash_points.py --prefix test_ --chunk_cap 2
+# python odynn_extract/extract_cash_points.py --prefix test_ --workers 4 --worker_type thread
+# python odynn_extract/extract_cash_points.py --workers 8 --slices 8
+# python odynn_extract/extract_cash_points.py --workers 8 --slices 8 --resume
+# python odynn_extract/extract_cash_points.py --incremental --pushdown
+# python odynn_extract/extract_cash_points.py --slices 8 --workers 8 --dedupe_bloom_mb 256
+# python odynn_extract/extract_cash_points.py --pipeline_depth 2
+# python odynn_extract/extract_cash_points.py --start_date 2023-10-01 --end_date 2023-10-08
+# python odynn_extract/extract_cash_points.py --workers 4 --memory_budget_mb 4096 --target_chunk_seconds 60
+# python odynn_extract/extract_cash_points.py --spool_dir spool --spool_only
+# python odynn_extract/extract_cash_points.py --workers 8 --slices 8 --load_mode staging
+# python odynn_extract/extract_cash_points.py --start_date 2023-10-01 --end_date 2023-10-08 --load_mode merge
+# python odynn_extract/extract_cash_points.py --workers 8 --slices 8 --latest_per_day
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Scrape and save REI data")
     parser.add_argument("--prefix", help="Optional prefix for table names. ", default="")
     parser.add_argument("--chunk_cap", help="Cap number of chunks for testing. None for unlimited", type=int, default=None)
+    parser.add_argument("--workers", help="Number of input_tables to extract in parallel. 1 runs serially", type=int, default=1)
+    parser.add_argument("--worker_type", help="Run parallel workers as processes or threads", choices=['process', 'thread'], default='process')
+    parser.add_argument("--slices", help="Split each input_table into N _id ranges, extracted by separate workers. While deduping across chunks "
+                        "(the default) or with --latest_per_day, ranges split at UTC midnights so each day's duplicates meet in one worker, "
+                        "so a table or date window spanning fewer days gets fewer ranges. --chunk_dedupe_only splits within days", type=int, default=1)
+    parser.add_argument("--resume", help="Resume each input_table from its last checkpointed chunk", action="store_true")
+    parser.add_argument("--incremental", help="Only extract documents above the highest _id already loaded per input_table", action="store_true")
+    parser.add_argument("--pushdown", help="Filter, flatten and parse chunks in a Mongo aggregation pipeline", action="store_true")
+    parser.add_argument("--chunk_dedupe_only", help="Only dedupe within each chunk, not across chunks of an input_table", action="store_true")
+    parser.add_argument("--dedupe_bloom_mb", help="Bound the cross-chunk dedupe index to a Bloom filter of this many MB", type=float, default=None)
+    parser.add_argument("--pipeline_depth", help="Overlap fetch, clean and load, queueing up to N chunks between stages. 0 runs them in turn", type=int, default=0)
+    parser.add_argument("--start_date", help="Only extract documents created on or after this date (YYYY-MM-DD)", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--end_date", help="Only extract documents created before this date (YYYY-MM-DD)", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--id_slack_hours", help="With --start_date/--end_date, only find documents whose created_at is within this many hours of their _id's timestamp", type=float, default=1)
+    parser.add_argument("--memory_budget_mb", help="Size chunks adaptively to keep each worker process's RSS under this many MB (shared by all workers with --worker_type thread)", type=float, default=None)
+    parser.add_argument("--target_chunk_seconds", help="Size chunks adaptively so each takes about this many seconds to fetch, clean and load", type=float, default=None)
+    parser.add_argument("--load_mode", help="append: load into the output tables. staging: load UNLOGGED staging tables, then swap them in. merge: upsert on _id", choices=['append', 'staging', 'merge'], default='append')
+    parser.add_argument("--spool_dir", help="Also write each cleaned chunk to a Parquet dataset here, for replay_spool.py (needs pyarrow)", default=None)
+    parser.add_argument("--latest_per_day", help="Only keep the latest row per hotel, award_category, stay date and created day", action="store_true")
+    parser.add_argument("--spool_only", help="With --spool_dir, only write the spool and skip loading Postgres", action="store_true")
     args = parser.parse_args()
 
-    main(args.prefix, args.chunk_cap)
\ No newline at end of file
+    main(args.prefix, args.chunk_cap, args.workers, args.worker_type, args.slices, args.resume, args.incremental, args.start_date, args.end_date, args.load_mode, args.id_slack_hours,
+         pushdown=args.pushdown, cross_chunk_dedupe=not args.chunk_dedupe_only, dedupe_bloom_mb=args.dedupe_bloom_mb,
+         pipeline_depth=args.pipeline_depth, memory_budget_mb=args.memory_budget_mb, target_chunk_seconds=args.target_chunk_seconds,
+         spool_dir=args.spool_dir, spool_only=args.spool_only, latest_per_day=args.latest_per_day)
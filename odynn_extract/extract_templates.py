@@ -1,12 +1,14 @@
 import os, time, logging, argparse, traceback
 import pandas as pd
-from pymongo import MongoClient
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from datetime import datetime
-from dotenv import load_dotenv
 
+from utils.table_utils import ExtractionSession
 from log.log_config import log_config
 
+env_str = "MONGO_URI"
+mongo_database = 'award_shopper'
+
 hotel_template_table_tuple = ('hotel_template_raw', {
         'hotel_group':'TEXT',
         'hotel_name': 'TEXT', # name (reserved word in postgresql)
@@ -62,22 +64,21 @@ def main(prefix):
     logger = log_config(f"{run_name}.log")
     logger.info(f"/n Starting {run_name}")
     
-    # Create output tables in postgresql if needed
-    create_table(run_table_tuple, prefix, logger)
-    columns_list, output_table_name = create_table(hotel_template_table_tuple, prefix, logger)
-    
-    # Generate run_id by inserting row into 'run' table
-    run_id = start_run(run_name, prefix, logger)
-    
-    for collection_name in collection_names:
-        df, dt = extract_data(collection_name, columns_list, logger, rename_dict)
-        helper_columns = {'run_id': run_id, 'dt': dt}
-        insert_to_sql(df, output_table_name, logger, helper_columns)
+    # One Mongo client and Postgres engine shared by every step of the run, closed when it ends
+    with ExtractionSession(env_str, mongo_database) as session:
+        # Create output tables in postgresql if needed
+        create_table(session, run_table_tuple, prefix, logger)
+        columns_list, output_table_name = create_table(session, hotel_template_table_tuple, prefix, logger)
+        
+        # Generate run_id by inserting row into 'run' table
+        run_id = start_run(session, run_name, prefix, logger)
+        
+        for collection_name in collection_names:
+            df, dt = extract_data(session, collection_name, columns_list, logger, rename_dict)
+            helper_columns = {'run_id': run_id, 'dt': dt}
+            insert_to_sql(session, df, output_table_name, logger, helper_columns)
 
-def insert_to_sql(df, output_table_name, logger, helper_columns=None):
-    load_dotenv() # load URI (can put this outside function too)
-    postgresql_uri = os.environ.get("POSTGRESQL_URI")
-    
+def insert_to_sql(session, df, output_table_name, logger, helper_columns=None):
     df = add_helper_columns(df, helper_columns)
     
     if df is None or df.empty:
@@ -85,7 +86,7 @@ def insert_to_sql(df, output_table_name, logger, helper_columns=None):
         return
     
     try:
-        engine = create_engine(postgresql_uri)
+        engine = session.postgres.engine
         with engine.connect() as conn:
             conn.execution_options(isolation_level="AUTOCOMMIT") # automatically commit insertions
             df.to_sql(output_table_name, engine, index=False, if_exists='append')
@@ -103,17 +104,14 @@ def add_helper_columns(df: pd.DataFrame, helper_columns: dict) -> pd.DataFrame:
                 df[column] = value
     return df
 
-def start_run(run_name, prefix, logger, details=''):
+def start_run(session, run_name, prefix, logger, details=''):
     run_dt = datetime.utcnow()
     output_table_name = f'{prefix}run'
     insert_query = text(f"INSERT INTO {output_table_name} (run_dt, run_name, details) VALUES (:run_dt, :run_name, :details) RETURNING run_id;")
     
-    load_dotenv() # load URI (can put this outside function too)
-    postgresql_uri = os.environ.get("POSTGRESQL_URI")   
     run_id = None # initialized in case of error
     try:
-        engine = create_engine(postgresql_uri)
-        with engine.connect() as conn:
+        with session.postgres.engine.connect() as conn:
             conn.execution_options(isolation_level="AUTOCOMMIT") # automatically commit insertions
             result = conn.execute(insert_query, {'run_dt': run_dt, 'run_name': run_name, 'details': details})
             run_id = result.fetchone()[0]
@@ -123,51 +121,45 @@ def start_run(run_name, prefix, logger, details=''):
         
         
 # query={} extracts all rows. Modify to filter, sort and/or start from a specific _id
-def extract_data(collection_name, columns_list, logger, rename_dict=None, query={}):
-    load_dotenv() # load URI (can put this outside function too)
-
+def extract_data(session, collection_name, columns_list, logger, rename_dict=None, query={}):
     try:
-        mongo_uri = os.environ.get("MONGO_URI")
-        with MongoClient(mongo_uri) as client:
-            collection = client.award_shopper[collection_name]
-            cursor = collection.find(query)#.sort([("_id", -1)]).limit(chunk_size)
-            
-            df = pd.DataFrame() # initialize df
-            df = pd.DataFrame(list(cursor))
-            
-            # Rename fields if needed
-            if rename_dict is not None:
-                df.rename(columns=rename_dict, inplace=True)
+        # Session client stays open for the next collection
+        collection = session.collection(collection_name)
+        cursor = collection.find(query)#.sort([("_id", -1)]).limit(chunk_size)
+        
+        df = pd.DataFrame() # initialize df
+        df = pd.DataFrame(list(cursor))
+        
+        # Rename fields if needed
+        if rename_dict is not None:
+            df.rename(columns=rename_dict, inplace=True)
 
-            # Unnest nested fields like 'coordinates'
-            if 'coordinates' in df.columns:
-                df['latitude'] = df['coordinates'].apply(lambda x: x.get('latitude', None))
-                df['longitude'] = df['coordinates'].apply(lambda x: x.get('longitude', None))
-                # df.drop('coordinates', axis=1, inplace=True)
-            if 'cash_value' in df.columns:
-                df['currency'] = df['cash_value'].apply(lambda x: x.get('currency', None))
-                # df.drop('cash_value', axis=1, inplace=True)
-            
-            # Create a list containing only columns in the df (drops 2 helper columns)
-            filtered_columns_list = [col for col in columns_list if col in df.columns]
-            df = df[filtered_columns_list] # Reorder and remove unneeded columns
-            
-            # convert _id field type to string so PostgreSQL can ingest
-            df['_id'] = df['_id'].astype(str)
-            df = df.applymap(lambda x: None if x == '' else x) # Replace empty strings with None, otherwise Numeric types fail upon insertion
+        # Unnest nested fields like 'coordinates'
+        if 'coordinates' in df.columns:
+            df['latitude'] = df['coordinates'].apply(lambda x: x.get('latitude', None))
+            df['longitude'] = df['coordinates'].apply(lambda x: x.get('longitude', None))
+            # df.drop('coordinates', axis=1, inplace=True)
+        if 'cash_value' in df.columns:
+            df['currency'] = df['cash_value'].apply(lambda x: x.get('currency', None))
+            # df.drop('cash_value', axis=1, inplace=True)
+        
+        # Create a list containing only columns in the df (drops 2 helper columns)
+        filtered_columns_list = [col for col in columns_list if col in df.columns]
+        df = df[filtered_columns_list] # Reorder and remove unneeded columns
+        
+        # convert _id field type to string so PostgreSQL can ingest
+        df['_id'] = df['_id'].astype(str)
+        df = df.applymap(lambda x: None if x == '' else x) # Replace empty strings with None, otherwise Numeric types fail upon insertion
 
-            dt = datetime.utcnow() # determine dt of extraction
+        dt = datetime.utcnow() # determine dt of extraction
     
-            return df, dt
+        return df, dt
     except Exception as e:
         logger.error(f'Error with extract_data on {collection_name}')
     
-def create_table(table_tuple, prefix, logger):
+def create_table(session, table_tuple, prefix, logger):
     output_table_name, columns = table_tuple
     output_table_name = f'{prefix}{output_table_name}' if prefix is not None else output_table_name # Add prefix, if exists
-    load_dotenv() # load URI (can put this outside function too)
-    postgresql_uri = os.environ.get("POSTGRESQL_URI")
-    
     # Generate columns_Sql as list of "NAME TYPE" for create table query
     columns_sql = [f"{column_name} {columns[column_name]}" for column_name in columns]
     columns_list = list(columns.keys()) # Extract a list of column names
@@ -180,8 +172,7 @@ def create_table(table_tuple, prefix, logger):
     """)
     
     # Open a Postgresql connection and create the table if it doesn't already exist
-    engine = create_engine(postgresql_uri)
-    with engine.connect() as conn:
+    with session.postgres.engine.connect() as conn:
         conn.execution_options(isolation_level="AUTOCOMMIT")
         logger.info(f"Executing query: {create_table_query}")
         conn.execute(create_table_query)
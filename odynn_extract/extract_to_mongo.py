@@ -1,78 +1,181 @@
-from datetime import datetime
-from itertools import islice
-from pymongo import MongoClient
+import asyncio
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 import os
 from dotenv import load_dotenv
 
 from log.log_config import log_config
+from utils.id_utils import date_id_range, build_id_boundary_cache, clear_id_boundary_cache, boundary_cache_collection
+
+def next_batch(cursor, batch_size):
+    # Blocking read of up to batch_size documents, run in a worker thread by transfer_data
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            break
+    return batch
+
+def get_watermark(dest_col):
+    # Last synced position of dest_col: the stored watermark if any, otherwise the highest _id already copied
+    watermark = dest_col.database[watermark_collection].find_one({'_id': dest_col.name})
+    if watermark is not None:
+        return watermark['max_id'], watermark.get('synced_at')
+    max_doc = dest_col.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    return (max_doc['_id'] if max_doc else None), None
+
+def save_watermark(dest_col, max_id, synced_at):
+    dest_col.database[watermark_collection].replace_one({'_id': dest_col.name}, {'_id': dest_col.name, 'max_id': max_id, 'synced_at': synced_at}, upsert=True)
+
+def clear_watermark(dest_col):
+    dest_col.database[watermark_collection].delete_one({'_id': dest_col.name})
+
+def only_duplicate_keys(error):
+    # Whether every failed write of a BulkWriteError is a duplicate _id (E11000), i.e. the document was already copied
+    write_errors = error.details.get('writeErrors', [])
+    return bool(write_errors) and all(write_error.get('code') == 11000 for write_error in write_errors)
+
+def sync_filter(table_name, max_id, synced_at):
+    # Documents newer than the watermark, plus (for collections whose documents change) any edited since the last sync
+    sync_query = {'_id': {'$gt': max_id}}
+    updated_field = upsert_field(table_name)
+    if updated_field and synced_at:
+        sync_query = {'$or': [sync_query, {updated_field: {'$gte': synced_at}}]}
+    return sync_query
+
+def upsert_field(table_name):
+    # Change-tracking field if table_name is a collection whose documents are edited in place, else None
+    for table_prefix, updated_field in upsert_tables.items():
+        if table_name.startswith(table_prefix):
+            return updated_field
+    return None
+
+async def transfer_data(logger, src_col, dest_col, query_filter=None, batch_size=100000, max_queued_batches=2, sync=False, raw=False, writers=1):
+    # Copy one collection, overlapping cursor reads with destination writes: a reader task fetches the next batch
+    # while `writers` writer tasks insert earlier ones, with at most max_queued_batches batches waiting in between.
+    # With sync=True keep the destination and only copy documents past its watermark, upserting by _id
+    # for collections in upsert_tables. With raw=True documents pass through as undecoded RawBSONDocuments
+    table_name = dest_col.name
+    if raw:
+        src_col = src_col.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    synced_at = datetime.utcnow()
+    max_id, last_synced_at = await asyncio.to_thread(get_watermark, dest_col) if sync else (None, None)
+    upsert = sync and upsert_field(table_name) is not None
+
+    if max_id is not None:
+        query_filter = sync_filter(table_name, max_id, last_synced_at)
+        logger.info(f"Syncing {table_name} from watermark max_id = {max_id}, synced_at = {last_synced_at}")
+    elif not sync:
+        # Clear the destination collection, if exists, and its watermark, which no longer describes what it holds
+        await asyncio.to_thread(dest_col.delete_many, {})
+        await asyncio.to_thread(clear_watermark, dest_col)
+        await asyncio.to_thread(clear_id_boundary_cache, dest_col, dest_col.database[boundary_cache_collection])
+
+    if query_filter and 'created_at' in query_filter:
+        # Because only _id is indexed, much faster to look up the _id range of the dates in the boundary cache versus filtering on created_at directly
+        cache_col = dest_col.database[boundary_cache_collection]
+        range_min_id, range_max_id, range_count = await asyncio.to_thread(date_id_range, src_col, cache_col, query_filter['created_at']['$gte'], query_filter['created_at']['$lt'], logger)
+        if not range_count:
+            return 0
 
-def get_id_range(logger, src_col, start_datetime, end_datetime):
-    logger.info(f"Getting id_range")
-    
-    # Find the max_id within the date range by scanning downward from end_datetime
-    max_doc = src_col.find({
-        'created_at': {'$lt': end_datetime},
-    }).sort([('_id', -1)]).limit(1)
-    
-    max_doc = list(max_doc)  # Convert cursor to list to access the result
-
-    if len(max_doc) > 0:
-        max_id = max_doc[0]['_id']
-        logger.info(f"Successfully got max_doc {max_doc}")
-        
-        # Find the min_id by scanning downward from the max_id - much faster than sort asending and scanning upward
-        min_doc = src_col.find_one({
-            'created_at': {'$gte': start_datetime, '$lt': end_datetime},
-            '_id': {'$lt': max_id}
-        })
-        
-        min_id = min_doc['_id'] if min_doc else None
-    else:
-        min_id = None
-        max_id = None
-    
-    max_id = max_doc[0]['_id'] if len(max_doc) > 0 else None
-    
-    logger.info(f"Successfully got min_doc {min_doc}")
-    return min_id, max_id
-
-def batch_iterator(iterator, batch_size):
-    while True:
-        batch = list(islice(iterator, batch_size))
-        if not batch:
-            return
-        yield batch
-
-def transfer_data(logger, src_col, dest_col, query_filter=None, batch_size=100000):
-    # Clear the destination collection, if exists
-    dest_col.delete_many({})
-    
-    if query_filter:
-        # Because only _id is indexed, much faster to find max/min _id for a given date range versus filtering on created_at directly
-        min_id, max_id = get_id_range(logger, src_col, query_filter.get('created_at').get('$gte'), query_filter.get('created_at').get('$lt'))
-        
         # Replace query_filter to only include _id range
-        if min_id and max_id:
-            query_filter = {'_id': {'$gte': min_id, '$lte': max_id}}
+        query_filter = {'_id': {'$gte': range_min_id, '$lte': range_max_id}}
 
     logger.info(f"Attempting to run query = {query_filter} on {src_col}")
-    cursor = src_col.find(query_filter)
+    cursor = src_col.find(query_filter, batch_size=batch_size)
+    if sync:
+        # Ascending _id order puts each batch's highest _id last, so the watermark never needs to decode other documents
+        cursor = cursor.sort([('_id', 1)])
     logger.info(f"Successfully created cursor with query = {query_filter}")
-    
-    success_count = 0
-    error_count = 0
-    
-    for batch in batch_iterator(cursor, batch_size):
+
+    batches = asyncio.Queue(maxsize=max_queued_batches)
+    progress = {'success_count': 0, 'error_count': 0, 'start_time': time.monotonic(), 'max_id': max_id}
+
+    async def reader():
         try:
-            dest_col.insert_many(batch)
-            logger.debug(f"Successfully inserted {len(batch)} documents into {src_col.name}.")
+            while batch := await asyncio.to_thread(next_batch, cursor, batch_size):
+                await batches.put(batch)
+        finally:
+            for _ in range(writers):
+                await batches.put(None) # tell each writer there is nothing left
+            cursor.close()
+
+    async def writer():
+        while (batch := await batches.get()) is not None:
+            try:
+                if upsert:
+                    requests = [ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in batch]
+                    await asyncio.to_thread(dest_col.bulk_write, requests, ordered=False)
+                else:
+                    try:
+                        await asyncio.to_thread(dest_col.insert_many, batch, ordered=False)
+                    except BulkWriteError as e:
+                        # Documents a partly failed sync already copied are rejected as duplicates, but they are in the
+                        # destination, so they count as copied and don't hold the watermark back forever
+                        if not only_duplicate_keys(e):
+                            raise
+                        logger.info(f"Skipped {len(e.details['writeErrors'])} documents already in {table_name}")
+                progress['success_count'] += len(batch)
+                if sync and (progress['max_id'] is None or batch[-1]['_id'] > progress['max_id']):
+                    progress['max_id'] = batch[-1]['_id']
+                logger.debug(f"Successfully inserted {len(batch)} documents into {table_name}.")
+            except Exception as e:
+                logger.error(f"Failed to insert batch into {table_name}: {e}")
+                progress['error_count'] += len(batch)
+
+            elapsed = time.monotonic() - progress['start_time']
+            logger.info(f"{table_name}: copied {progress['success_count']} documents ({progress['success_count'] / max(elapsed, 1e-6):.0f} docs/sec)")
+
+    await asyncio.gather(reader(), *[writer() for _ in range(writers)])
+
+    logger.info(f"Successfully inserted {progress['success_count']} documents into {table_name}")
+    if sync and progress['success_count']:
+        # Cached _id boundaries of days this sync added documents to are stale now. New documents are above the
+        # watermark, so only days from the watermark's (less a day of created_at slack) on are dropped
+        from_day = max_id.generation_time.replace(tzinfo=None) - timedelta(days=1) if max_id is not None else None
+        await asyncio.to_thread(clear_id_boundary_cache, dest_col, dest_col.database[boundary_cache_collection], from_day)
+    if progress['error_count']:
+        logger.error(f"Failed to insert {progress['error_count']} documents into {table_name}")
+        if sync:
+            # Pin the watermark where this sync started, even if none was stored, so the next sync doesn't fall back to
+            # the highest _id copied, which can be above the failed batches
+            await asyncio.to_thread(save_watermark, dest_col, max_id, last_synced_at)
+    elif sync and progress['max_id'] is not None:
+        # Only advance the watermark when every batch landed, so failed documents are retried next sync
+        await asyncio.to_thread(save_watermark, dest_col, progress['max_id'], synced_at)
+    return progress['success_count']
+
+async def transfer_collection(logger, semaphore, src_db, dest_db, table_name, query_filter, batch_size, sync=False, raw=False, writers=1):
+    # The semaphore caps how many collections are copied at once across the whole run
+    async with semaphore:
+        logger.info(f"Transferring data for {table_name}")
+        logger.info(f"query = {query_filter}")
+        try:
+            await transfer_data(logger, src_db[table_name], dest_db[table_name], query_filter=query_filter, batch_size=batch_size, sync=sync, raw=raw, writers=writers)
         except Exception as e:
-            logger.error(f"Failed to insert batch: {e}")
-            error_count += len(batch)
-    
-    logger.info(f"Successfully inserted {success_count} documents into {dest_col.name}")
-    if error_count:
-        logger.error(f"Failed to insert {error_count} documents into {dest_col.name}")
+            logger.error(f"Failed to transfer data for {table_name}: {e}")
+        logger.info(f"Data transfer complete for {table_name}!")
+
+async def transfer_all(logger, src_uri, dest_uri, table_names, date_filter, concurrency, batch_size, sync=False, raw=False, writers=1):
+    # Each running collection uses up to 1 + writers threads (one read, the rest writes), so size the default executor to match
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=(1 + writers) * concurrency + 1))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with MongoClient(src_uri) as src_client, MongoClient(dest_uri) as dest_client:
+        src_db = src_client['award_shopper']
+        dest_db = dest_client['awayzDB']
+
+        await asyncio.gather(*[
+            transfer_collection(logger, semaphore, src_db, dest_db, table_name,
+                                date_filter if 'hotel_calendar' in table_name else None, batch_size, sync, raw, writers)
+            for table_name in table_names
+        ])
 
 # Load environment variables
 load_dotenv()
@@ -80,7 +183,7 @@ src_uri = os.getenv("MONGO_URI")
 dest_uri = os.getenv("OUTPUT_MONGO_URI")
 
 mongo_hotels = [
-    #'hilton', 'hyatt','ihg', 'marriott', 
+    #'hilton', 'hyatt','ihg', 'marriott',
     # 'accor',
     'choice']
 mongo_tables = [
@@ -93,30 +196,49 @@ end_datetime = datetime(2023, 10, 2, 0, 0, 0)
 
 date_filter = {'created_at': {'$gte': start_datetime, '$lt': end_datetime}}
 
-# Initialize logging
-script_name = os.path.splitext(os.path.basename(__file__))[0]
-log_file_name = f"{script_name}.log"
-logger = log_config(log_file_name)
-
-logger.info('STARTING NEW RUN\n')
-
-with MongoClient(src_uri) as src_client, MongoClient(dest_uri) as dest_client:
-    src_db = src_client['award_shopper']
-    dest_db = dest_client['awayzDB']
-
-    for hotel in mongo_hotels:
-        for table in mongo_tables:
-            table_name = f"{table}_{hotel}"
-            logger.info(f"Transferring data for {table_name}")
-            
-            src_col = src_db[table_name]
-            dest_col = dest_db[table_name]
-            
-            query_filter = date_filter if 'hotel_calendar' in table_name else None
-            logger.info(f"query = {query_filter}")
-            
+# Sync mode: collections whose documents are edited in place are upserted by _id, and also re-copied when this
+# field is newer than the last sync. Other collections are append-only, so only _ids above the watermark are copied
+upsert_tables = {
+    'hotel_directory_templates': 'updated_at',
+}
+watermark_collection = 'transfer_watermarks' # per-collection sync watermarks, stored in the destination database
+
+def build_id_caches(logger, src_uri, dest_uri, table_names):
+    # Extend each source collection's created_at -> _id boundary cache (kept in the destination database) up to today
+    with MongoClient(src_uri) as src_client, MongoClient(dest_uri) as dest_client:
+        cache_col = dest_client['awayzDB'][boundary_cache_collection]
+        for table_name in table_names:
             try:
-                transfer_data(logger, src_col, dest_col, query_filter=query_filter)
+                days_built = build_id_boundary_cache(src_client['award_shopper'][table_name], cache_col, logger)
+                logger.info(f"Extended _id boundary cache for {table_name} by {days_built} days")
             except Exception as e:
-                logger.error(f"Failed to transfer data for {table_name}")
-            logger.info(f"Data transfer complete for {table_name}!")
\ No newline at end of file
+                logger.error(f"Failed to build _id boundary cache for {table_name}: {e}")
+
+def main(concurrency, batch_size, sync=False, raw=False, writers=1, build_id_cache=False):
+    # Initialize logging
+    script_name = os.path.splitext(os.path.basename(__file__))[0]
+    log_file_name = f"{script_name}.log"
+    logger = log_config(log_file_name)
+
+    logger.info(f'STARTING NEW RUN concurrency={concurrency} batch_size={batch_size} sync={sync} raw={raw} writers={writers}\n')
+
+    table_names = [f"{table}_{hotel}" for hotel in mongo_hotels for table in mongo_tables]
+    if build_id_cache:
+        build_id_caches(logger, src_uri, dest_uri, table_names)
+    asyncio.run(transfer_all(logger, src_uri, dest_uri, table_names, date_filter, concurrency, batch_size, sync, raw, writers))
+
+# python odynn_extract/extract_to_mongo.py --concurrency 4
+# python odynn_extract/extract_to_mongo.py --sync
+# python odynn_extract/extract_to_mongo.py --raw --writers 4
+# python odynn_extract/extract_to_mongo.py --build_id_cache
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy award_shopper collections into awayzDB")
+    parser.add_argument("--concurrency", help="Number of collections copied at the same time", type=int, default=4)
+    parser.add_argument("--batch_size", help="Documents per read/insert batch", type=int, default=100000)
+    parser.add_argument("--sync", help="Copy only documents past each destination's watermark instead of delete + full recopy", action="store_true")
+    parser.add_argument("--raw", help="Pass documents through as raw BSON without decoding them", action="store_true")
+    parser.add_argument("--writers", help="Parallel insert threads per collection", type=int, default=1)
+    parser.add_argument("--build_id_cache", help="Extend the created_at -> _id boundary cache of every collection before transferring", action="store_true")
+    args = parser.parse_args()
+
+    main(args.concurrency, args.batch_size, args.sync, args.raw, args.writers, args.build_id_cache)
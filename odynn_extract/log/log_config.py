@@ -26,4 +26,12 @@ def log_config(script_filename, logger_name='CentralLogger'):
         # Add the file handler to the logger
         logger.addHandler(file_handler)
     
-    return logger
\ No newline at end of file
+    return logger
+
+class WorkerLoggerAdapter(logging.LoggerAdapter):
+    # Prefix each message with the worker name so interleaved logs from parallel workers stay readable
+    def process(self, msg, kwargs):
+        return f"[{self.extra['worker']}] {msg}", kwargs
+
+def worker_logger(logger, worker_name):
+    return WorkerLoggerAdapter(logger, {'worker': worker_name})
@@ -0,0 +1,79 @@
+import os
+import argparse
+import traceback
+from datetime import datetime
+
+from utils.settings_cash_points import input_output_dict, dtypes_cash_points
+from utils.table_utils import PostgresInserter
+from utils.spool_utils import list_spool_files, read_spool_file
+from log.log_config import log_config
+
+# Load the Parquet spool written by extract_cash_points.py --spool_dir into Postgres, without touching Mongo.
+# Spooled rows keep the run_id, input_table and chunk_n of the extract that produced them; the replay itself is
+# recorded as its own row in {prefix}run
+
+script_filename = os.path.basename(os.path.abspath(__file__))
+run_name = os.path.splitext(script_filename)[0]
+
+def replay_table(postgres_conn, spool_dir, spool_table, output_table, columns_dict, load_method, logger, run_ids=None, hotel_groups=None, start_date=None, end_date=None, partition=None, merge=False):
+    # Load every matching spool file of spool_table into output_table, one file per COPY. Returns rows loaded, None on failure
+    # With merge, rows are upserted on _id, so replaying files that are already loaded doesn't duplicate them
+    column_order = postgres_conn.create_table(output_table, columns_dict, logger, partition=partition)
+    merge_keys = postgres_conn.merge_key_columns(output_table, partition) if merge else None
+    if merge_keys and not postgres_conn.create_merge_index(output_table, merge_keys, logger):
+        return None
+    dtypes = dtypes_cash_points(columns_dict)
+    file_paths = list_spool_files(spool_dir, spool_table, hotel_groups, start_date, end_date)
+    logger.info(f'Replaying {len(file_paths)} spool files of {spool_table} into {output_table}')
+
+    rows_loaded = 0
+    for file_path in file_paths:
+        df, metadata = read_spool_file(file_path)
+        if run_ids and metadata.get('run_id') not in run_ids:
+            continue
+        if postgres_conn.insert_postgres(df, output_table, logger, None, column_order, load_method, dtypes, partition, merge_keys) is None:
+            logger.error(f'Stopping replay of {spool_table} at {file_path} after {rows_loaded} rows')
+            return None
+        rows_loaded += len(df)
+        logger.debug(f"Replayed {len(df)} rows from {file_path} (run_id = {metadata.get('run_id')}, _id {metadata.get('min_id')} - {metadata.get('max_id')})")
+
+    logger.info(f'Replayed {rows_loaded} rows of {spool_table} into {output_table}')
+    return rows_loaded
+
+def main(spool_dir, prefix, spool_prefix='', table_types=None, run_ids=None, hotel_groups=None, start_date=None, end_date=None, merge=False):
+    logger = log_config(script_filename)
+
+    with PostgresInserter() as postgres_conn:
+        details = f'spool_dir = {spool_dir}, spool_prefix = {spool_prefix}, run_ids = {run_ids}, hotel_groups = {hotel_groups}, start_date = {start_date}, end_date = {end_date}, merge = {merge}'
+        replay_run_id = postgres_conn.start_run(run_name, prefix, logger, details=details)
+        logger.info(f'\nStarting replay run #{replay_run_id}. prefix={prefix} {details}')
+
+        for table_type, table_type_dict in input_output_dict.items():
+            if table_types and table_type not in table_types:
+                continue
+            table_name = table_type_dict['output_table']['table_name']
+            try:
+                replay_table(postgres_conn, spool_dir, f'{spool_prefix}{table_name}', f'{prefix}{table_name}',
+                             table_type_dict['output_table']['table_columns'], table_type_dict['output_table'].get('load_method', 'to_sql'),
+                             logger, run_ids, hotel_groups, start_date, end_date, table_type_dict['output_table'].get('partition'), merge)
+            except Exception as e:
+                logger.error(f'Error replaying {table_type} spool from {spool_dir}. {e}')
+                logger.error({traceback.format_exc()})
+
+# python odynn_extract/replay_spool.py --spool_dir spool
+# python odynn_extract/replay_spool.py --spool_dir spool --prefix test_ --hotel_groups accor --start_date 2023-10-01 --end_date 2023-10-08
+# python odynn_extract/replay_spool.py --spool_dir spool --merge
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a Parquet spool of cleaned chunks into Postgres")
+    parser.add_argument("--spool_dir", help="Spool directory written by extract_cash_points.py --spool_dir", required=True)
+    parser.add_argument("--prefix", help="Optional prefix for the Postgres tables loaded", default="")
+    parser.add_argument("--spool_prefix", help="Table prefix the spool was extracted with", default="")
+    parser.add_argument("--table_types", help="Only replay these table types", nargs='+', choices=list(input_output_dict), default=None)
+    parser.add_argument("--run_ids", help="Only replay chunks spooled by these extract runs", nargs='+', default=None)
+    parser.add_argument("--hotel_groups", help="Only replay these hotel_group partitions", nargs='+', default=None)
+    parser.add_argument("--start_date", help="Only replay created_at days on or after this date (YYYY-MM-DD)", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--end_date", help="Only replay created_at days before this date (YYYY-MM-DD)", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--merge", help="Upsert rows on _id instead of appending them", action="store_true")
+    args = parser.parse_args()
+
+    main(args.spool_dir, args.prefix, args.spool_prefix, args.table_types, args.run_ids, args.hotel_groups, args.start_date, args.end_date, args.merge)
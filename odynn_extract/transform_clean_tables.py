@@ -0,0 +1,220 @@
+import os
+import argparse
+import traceback
+from datetime import datetime
+from sqlalchemy import text
+
+from utils.table_utils import PostgresInserter
+from log.log_config import log_config
+
+# Incremental version of the "CREATE CLEAN TABLES" steps of odynn_transform/data_sample.sql. Instead of rebuilding
+# hotel_cash / hotel_points from the whole raw history, only raw rows from extract runs not yet transformed are read,
+# reduced to the latest row per (hotel_group, hotel_name_key, date_stay, date_booked) and merged into the clean table,
+# keeping whichever row of a key was created last. Progress is kept per raw table and run in {prefix}transform_run
+
+script_filename = os.path.basename(os.path.abspath(__file__))
+run_name = os.path.splitext(script_filename)[0]
+
+templates_table = 'hotel_templates'
+template_filter = "slug_city = 'new-york'"
+key_columns = ['hotel_group', 'hotel_name_key', 'date_stay', 'date_booked']
+
+transform_dict = {
+    'cash': {
+        'raw_table': 'hotel_cash_raw',
+        'clean_table': 'hotel_cash',
+        'raw_filter': "currency = 'USD' AND cash_value > 1",
+        # clean column -> expression over the raw table
+        'select_columns': {
+            'hotel_group': 'hotel_group',
+            'hotel_name_key': 'hotel_name_key',
+            'hotel_id': 'hotel_id',
+            'date_stay': 'date(date)',
+            'date_booked': 'date(created_at)',
+            'cash': 'cash_value',
+            'currency': 'currency',
+            'created_at': 'created_at',
+            '_id': '_id',
+        },
+        'table_columns': {
+            'hotel_group': 'TEXT',
+            'hotel_name_key': 'TEXT',
+            'hotel_id': 'TEXT',
+            'date_stay': 'DATE',
+            'date_booked': 'DATE',
+            'cash': 'NUMERIC',
+            'currency': 'TEXT',
+            'created_at': 'TIMESTAMP',
+            '_id': 'TEXT',
+        },
+    },
+    'points': {
+        'raw_table': 'hotel_points_raw',
+        'clean_table': 'hotel_points',
+        'raw_filter': 'points > 1',
+        'select_columns': {
+            'hotel_group': 'hotel_group',
+            'hotel_name_key': 'hotel_name_key',
+            'hotel_id': 'hotel_id',
+            'date_stay': 'date(date)',
+            'date_booked': 'date(created_at)',
+            'points': 'points',
+            'created_at': 'created_at',
+            '_id': '_id',
+        },
+        'table_columns': {
+            'hotel_group': 'TEXT',
+            'hotel_name_key': 'TEXT',
+            'hotel_id': 'TEXT',
+            'date_stay': 'DATE',
+            'date_booked': 'DATE',
+            'points': 'NUMERIC',
+            'created_at': 'TIMESTAMP',
+            '_id': 'TEXT',
+        },
+    },
+}
+
+def create_transform_run_table(postgres_conn, prefix, logger):
+    # One row per raw run merged into a clean table: raw rows it had when last merged, and whether it is closed
+    table_name = f"{prefix}transform_run"
+    columns_dict = {
+        'raw_table': 'TEXT NOT NULL',
+        'clean_table': 'TEXT NOT NULL',
+        'run_id': 'INTEGER NOT NULL',
+        'raw_rows': 'BIGINT',
+        'rows_merged': 'BIGINT',
+        'closed': 'BOOLEAN',
+        'updated_dt': 'TIMESTAMP',
+    }
+    postgres_conn.create_table(table_name, columns_dict, logger, constraints=['PRIMARY KEY (raw_table, clean_table, run_id)'])
+    return table_name
+
+def load_transform_runs(connection, transform_run_table, raw_table, clean_table):
+    # run_id -> (raw_rows, closed) of every run already merged from raw_table into clean_table
+    select_query = text(f"SELECT run_id, raw_rows, closed FROM {transform_run_table} WHERE raw_table = :raw_table AND clean_table = :clean_table;")
+    return {row.run_id: (row.raw_rows, row.closed) for row in connection.execute(select_query, {'raw_table': raw_table, 'clean_table': clean_table})}
+
+def save_transform_run(connection, transform_run_table, raw_table, clean_table, run_id, raw_rows, rows_merged, closed):
+    upsert_query = text(f"INSERT INTO {transform_run_table} (raw_table, clean_table, run_id, raw_rows, rows_merged, closed, updated_dt) "
+                        f"VALUES (:raw_table, :clean_table, :run_id, :raw_rows, :rows_merged, :closed, :updated_dt) "
+                        f"ON CONFLICT (raw_table, clean_table, run_id) DO UPDATE SET raw_rows = EXCLUDED.raw_rows, "
+                        f"rows_merged = {transform_run_table}.rows_merged + EXCLUDED.rows_merged, closed = EXCLUDED.closed, updated_dt = EXCLUDED.updated_dt;")
+    connection.execute(upsert_query, {'raw_table': raw_table, 'clean_table': clean_table, 'run_id': run_id, 'raw_rows': raw_rows,
+                                      'rows_merged': rows_merged, 'closed': closed, 'updated_dt': datetime.utcnow()})
+
+def count_run_rows(connection, raw_table, run_id):
+    return connection.execute(text(f"SELECT count(*) FROM {raw_table} WHERE run_id = :run_id;"), {'run_id': str(run_id)}).scalar()
+
+def count_open_checkpoints(connection, checkpoint_table, run_id):
+    # _id ranges extract_cash_points.py run run_id is still working on (see {prefix}run_checkpoint). Every range is saved
+    # as the run's before it loads a row, and completed after its last chunk, so none left means no more rows will come
+    if connection.execute(text("SELECT to_regclass(:table_name)"), {'table_name': checkpoint_table}).scalar() is None:
+        return 0
+    return connection.execute(text(f"SELECT count(*) FROM {checkpoint_table} WHERE run_id = :run_id AND NOT completed;"), {'run_id': run_id}).scalar()
+
+def list_run_ids(connection, raw_table):
+    # Distinct run_ids of raw_table via a loose index scan on its run_id index: one index probe per run, not a full scan.
+    # run_id is TEXT in the raw tables, so ids are compared as integers here and non-numeric ones skipped
+    select_query = text(f"WITH RECURSIVE runs AS ("
+                        f"SELECT min(run_id) AS run_id FROM {raw_table} "
+                        f"UNION ALL SELECT (SELECT min(run_id) FROM {raw_table} WHERE run_id > runs.run_id) FROM runs WHERE runs.run_id IS NOT NULL) "
+                        f"SELECT run_id FROM runs WHERE run_id IS NOT NULL;")
+    return sorted(int(run_id) for (run_id,) in connection.execute(select_query) if run_id.isdigit())
+
+def merge_run(connection, transform, raw_table, clean_table, template_table, run_id):
+    # Latest raw row per key from one run, merged into clean_table. An existing clean row is only replaced by a row
+    # created at or after it, so the result matches rebuilding from the whole raw history
+    select_columns = transform['select_columns']
+    key_expressions = [select_columns[column] for column in key_columns]
+    update_columns = ', '.join(f"{column} = EXCLUDED.{column}" for column in select_columns if column not in key_columns)
+    merge_query = text(
+        f"INSERT INTO {clean_table} ({', '.join(select_columns)}) "
+        f"SELECT DISTINCT ON ({', '.join(key_expressions)}) {', '.join(select_columns.values())} "
+        f"FROM {raw_table} a "
+        f"WHERE run_id = :run_id AND {transform['raw_filter']} "
+        f"AND date(created_at) <= date(date) " # remove booking dates in the past
+        f"AND NULLIF(hotel_name_key,'') IS NOT NULL "
+        f"AND EXISTS (SELECT 1 FROM {template_table} b WHERE b.{template_filter} AND b.hotel_group = a.hotel_group AND b.hotel_id = a.hotel_id) "
+        f"ORDER BY {', '.join(key_expressions)}, created_at DESC "
+        f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {update_columns} "
+        f"WHERE EXCLUDED.created_at >= {clean_table}.created_at;")
+    return connection.execute(merge_query, {'run_id': str(run_id)}).rowcount
+
+def transform_table(postgres_conn, transform, prefix, transform_run_table, logger, full=False):
+    # Merge every run of the raw table that isn't closed yet into the clean table, one transaction per run so its
+    # transform_run row only changes with the rows it covers. Returns the rows inserted or updated, None on failure
+    raw_table = f"{prefix}{transform['raw_table']}"
+    clean_table = f"{prefix}{transform['clean_table']}"
+    template_table = f"{prefix}{templates_table}"
+
+    # Clean tables built by data_sample.sql already hold one row per key, so the unique index can be added to them in place
+    if postgres_conn.create_table(clean_table, transform['table_columns'], logger) is None:
+        return None
+    if not postgres_conn.create_merge_index(clean_table, key_columns, logger):
+        return None
+    with postgres_conn.engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {raw_table}_run_id_idx ON {raw_table} (run_id)"))
+        transform_runs = {} if full else load_transform_runs(connection, transform_run_table, raw_table, clean_table)
+        run_ids = list_run_ids(connection, raw_table)
+
+    # A run can still be loading rows when it is first merged (e.g. a long backfill overlapping later daily runs), so
+    # runs are merged again (merging is idempotent) until they have no unfinished _id ranges left in the extract's
+    # run_checkpoint table, which closes them. A run that stopped part way stays open until --resume takes its ranges
+    # over. Only closed runs are skipped
+    run_ids = [run_id for run_id in run_ids if not transform_runs.get(run_id, (None, False))[1]]
+    logger.info(f"Transforming {raw_table} into {clean_table}: {len(run_ids)} open runs {run_ids}")
+
+    rows_merged = 0
+    for run_id in run_ids:
+        try:
+            with postgres_conn.engine.begin() as connection:
+                # Checked before merging, so a run still loading when the merge starts is merged again next pass
+                closed = count_open_checkpoints(connection, f"{prefix}run_checkpoint", run_id) == 0
+                raw_rows = count_run_rows(connection, raw_table, run_id)
+                merged_count = merge_run(connection, transform, raw_table, clean_table, template_table, run_id)
+                save_transform_run(connection, transform_run_table, raw_table, clean_table, run_id, raw_rows, merged_count, closed)
+        except Exception as e:
+            logger.error(f"Error merging run_id {run_id} of {raw_table} into {clean_table}, it stays open for the next pass. {e}")
+            logger.error({traceback.format_exc()})
+            return None
+        rows_merged += merged_count
+        logger.info(f"Merged run_id {run_id} of {raw_table} into {clean_table}: {merged_count} of {raw_rows} raw rows inserted or updated"
+                    + (", closed it" if closed else ", it is still extracting"))
+
+    if run_ids:
+        with postgres_conn.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(text(f"ANALYZE {clean_table}"))
+    logger.info(f"Transformed {raw_table} into {clean_table}: {rows_merged} rows inserted or updated")
+    return rows_merged
+
+def main(prefix, table_types=None, full=False):
+    logger = log_config(script_filename)
+
+    with PostgresInserter() as postgres_conn:
+        run_id = postgres_conn.start_run(run_name, prefix, logger, details=f'table_types = {table_types}, full = {full}')
+        logger.info(f'\nStarting transform run #{run_id}. prefix={prefix} table_types={table_types} full={full}')
+        transform_run_table = create_transform_run_table(postgres_conn, prefix, logger)
+
+        for table_type, transform in transform_dict.items():
+            if table_types and table_type not in table_types:
+                continue
+            try:
+                transform_table(postgres_conn, transform, prefix, transform_run_table, logger, full)
+            except Exception as e:
+                logger.error(f'Error transforming {table_type}. {e}')
+                logger.error({traceback.format_exc()})
+
+# python odynn_extract/transform_clean_tables.py
+# python odynn_extract/transform_clean_tables.py --prefix test_ --table_types cash
+# python odynn_extract/transform_clean_tables.py --full
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge raw cash and points rows from new extract runs into the clean tables")
+    parser.add_argument("--prefix", help="Optional prefix for table names", default="")
+    parser.add_argument("--table_types", help="Only transform these table types", nargs='+', choices=list(transform_dict), default=None)
+    parser.add_argument("--full", help="Merge every run again, closed ones too, e.g. after adding hotel templates", action="store_true")
+    args = parser.parse_args()
+
+    main(args.prefix, args.table_types, args.full)
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+
+boundary_cache_collection = 'id_boundary_cache' # per collection and created_at day (min_id, max_id, count), see day_boundaries
+
+def get_id_bounds(collection, query=None):
+    # Smallest and largest _id matching query, using the _id index in both directions
+    query = query or {}
+    min_doc = collection.find_one(query, {'_id': 1}, sort=[('_id', 1)])
+    max_doc = collection.find_one(query, {'_id': 1}, sort=[('_id', -1)])
+    if min_doc is None or max_doc is None:
+        return None, None
+    return min_doc['_id'], max_doc['_id']
+
+def next_object_id(object_id):
+    # Smallest ObjectId greater than object_id, to turn an inclusive watermark into an exclusive lower bound
+    return ObjectId(format(int(str(object_id), 16) + 1, '024x'))
+
+def plan_id_ranges(collection, n_slices, logger, sample_size=1000, lower_id=None, upper_id=None, align_days=False):
+    # Split a collection's _id space (within [lower_id, upper_id), if given) into n_slices disjoint [lower_id, upper_id) ranges
+    # by embedded timestamp. None means unbounded, so the ranges together always cover the whole collection.
+    # align_days puts every boundary at a UTC midnight, so each scrape day falls in one slice (possibly fewer slices)
+    if n_slices is None or n_slices <= 1:
+        return [(lower_id, upper_id)]
+
+    min_id, max_id = get_id_bounds(collection, id_range_query(lower_id, upper_id))
+    if min_id is None:
+        return [(lower_id, upper_id)]
+
+    # Balance slices on a random sample of _ids, so busy scrape days get narrower time slices
+    try:
+        cursor = collection.aggregate([{'$match': id_range_query(lower_id, upper_id)}, {'$sample': {'size': sample_size}}, {'$project': {'_id': 1}}])
+        sampled_ids = sorted(doc['_id'] for doc in cursor)
+    except Exception as e:
+        logger.warning(f'Sampling {collection.name} failed, splitting by time evenly. {e}')
+        sampled_ids = []
+
+    if len(sampled_ids) >= n_slices:
+        boundary_times = [sampled_ids[len(sampled_ids) * i // n_slices].generation_time for i in range(1, n_slices)]
+    else:
+        # Too few samples to balance on, so split min_id - max_id into equal time intervals
+        min_dt, max_dt = min_id.generation_time, max_id.generation_time
+        boundary_times = [min_dt + (max_dt - min_dt) * i / n_slices for i in range(1, n_slices)]
+    if align_days:
+        boundary_times = [dt.replace(hour=0, minute=0, second=0, microsecond=0) for dt in boundary_times]
+
+    # ObjectId.from_datetime gives the smallest _id for that second, so each boundary cleanly separates slices
+    boundaries = sorted({ObjectId.from_datetime(dt) for dt in boundary_times})
+    boundaries = [boundary for boundary in boundaries if min_id < boundary <= max_id]
+
+    lower_ids = [lower_id] + boundaries
+    upper_ids = boundaries + [upper_id]
+    id_ranges = list(zip(lower_ids, upper_ids))
+    logger.info(f'Planned {len(id_ranges)} _id ranges for {collection.name}: {id_ranges}')
+    if align_days and len(id_ranges) < n_slices:
+        logger.warning(f'Only {len(id_ranges)} of {n_slices} slices for {collection.name}: slices are aligned to days and its _ids span '
+                       f'{min_id.generation_time:%Y-%m-%d} - {max_id.generation_time:%Y-%m-%d}')
+    return id_ranges
+
+def id_range_query(lower_id=None, upper_id=None):
+    # Mongo _id filter for [lower_id, upper_id), empty if unbounded
+    id_filter = {}
+    if lower_id is not None:
+        id_filter['$gte'] = ObjectId(lower_id)
+    if upper_id is not None:
+        id_filter['$lt'] = ObjectId(upper_id)
+    return {'_id': id_filter} if id_filter else {}
+
+def created_at_boundaries(collection, start_datetime, end_datetime, slack=timedelta(hours=1)):
+    # min_id, max_id and count of documents with created_at in [start_datetime, end_datetime). created_at is unindexed, so only
+    # check it on the _id window padded by slack around the range, which the _id index finds without a collection scan
+    window_query = id_range_query(ObjectId.from_datetime(start_datetime - slack), ObjectId.from_datetime(end_datetime + slack))
+    result = next(collection.aggregate([
+        {'$match': {**window_query, 'created_at': {'$gte': start_datetime, '$lt': end_datetime}}},
+        {'$group': {'_id': None, 'min_id': {'$min': '$_id'}, 'max_id': {'$max': '$_id'}, 'count': {'$sum': 1}}},
+    ]), None)
+    if result is None:
+        return None, None, 0
+    return result['min_id'], result['max_id'], result['count']
+
+def day_boundaries(collection, cache_collection, day, slack=timedelta(hours=1), rebuild=False):
+    # Boundaries of one created_at day, read from cache_collection if already built. Days are only cached once they are
+    # over (plus slack), since documents can still be added to a day in progress, and only if they have documents, since
+    # a day that is empty now may just not have been copied into this database yet. A day cached with another slack is rebuilt
+    day = datetime(day.year, day.month, day.day)
+    cache_key = f'{collection.database.name}.{collection.name}:{day:%Y-%m-%d}'
+    if not rebuild:
+        cached = cache_collection.find_one({'_id': cache_key})
+        if cached is not None and cached.get('slack_seconds', 3600) == slack.total_seconds():
+            return cached['min_id'], cached['max_id'], cached['count']
+
+    min_id, max_id, count = created_at_boundaries(collection, day, day + timedelta(days=1), slack)
+    if count and day + timedelta(days=1) + slack <= datetime.utcnow():
+        cache_collection.replace_one({'_id': cache_key}, {
+            '_id': cache_key, 'database': collection.database.name, 'collection': collection.name, 'day': day,
+            'min_id': min_id, 'max_id': max_id, 'count': count, 'slack_seconds': slack.total_seconds(), 'built_at': datetime.utcnow(),
+        }, upsert=True)
+    return min_id, max_id, count
+
+def clear_id_boundary_cache(collection, cache_collection, from_day=None):
+    # Drop the cached boundaries of collection (of days from from_day on, if given), e.g. after its documents were rewritten
+    cache_query = {'database': collection.database.name, 'collection': collection.name}
+    if from_day is not None:
+        cache_query['day'] = {'$gte': datetime(from_day.year, from_day.month, from_day.day)}
+    return cache_collection.delete_many(cache_query).deleted_count
+
+def build_id_boundary_cache(collection, cache_collection, logger, start_day=None, end_day=None, slack=timedelta(hours=1), rebuild=False):
+    # Extend the boundary cache of collection one day at a time up to end_day (default today, exclusive). Without start_day,
+    # continue from the day after the last cached one, or from the day of the collection's first _id
+    if start_day is None and not rebuild:
+        last_cached = cache_collection.find_one({'database': collection.database.name, 'collection': collection.name}, sort=[('day', -1)])
+        start_day = last_cached['day'] + timedelta(days=1) if last_cached else None
+    if start_day is None:
+        min_id, _ = get_id_bounds(collection)
+        if min_id is None:
+            return 0
+        start_day = min_id.generation_time.replace(tzinfo=None)
+    day = datetime(start_day.year, start_day.month, start_day.day)
+    end_day = end_day or datetime.utcnow()
+
+    days_built = 0
+    while day < end_day:
+        min_id, max_id, count = day_boundaries(collection, cache_collection, day, slack, rebuild)
+        logger.debug(f'{collection.name} {day:%Y-%m-%d}: count = {count}, min_id = {min_id}, max_id = {max_id}')
+        day += timedelta(days=1)
+        days_built += 1
+    return days_built
+
+def date_id_range(collection, cache_collection, start_datetime, end_datetime, logger, slack=timedelta(hours=1)):
+    # Turn a created_at range into the (min_id, max_id, count) of the documents in it: whole days come from the boundary
+    # cache (built on first use), partial days at either end are computed directly. max_id is inclusive.
+    # Documents are only found within slack of their _id's timestamp, so days before the collection's first _id are skipped
+    first_id, _ = get_id_bounds(collection)
+    if first_id is None:
+        logger.info(f'No documents in {collection.name}')
+        return None, None, 0
+    range_start = max(start_datetime, first_id.generation_time.replace(tzinfo=None) - slack)
+
+    day_ranges = []
+    day = datetime(range_start.year, range_start.month, range_start.day)
+    while day < end_datetime:
+        day_ranges.append((max(day, range_start), min(day + timedelta(days=1), end_datetime)))
+        day += timedelta(days=1)
+
+    min_ids, max_ids, total_count = [], [], 0
+    for range_start, range_end in day_ranges:
+        whole_day = range_start.time() == datetime.min.time() and range_end - range_start == timedelta(days=1)
+        if whole_day and cache_collection is not None:
+            min_id, max_id, count = day_boundaries(collection, cache_collection, range_start, slack)
+        else:
+            min_id, max_id, count = created_at_boundaries(collection, range_start, range_end, slack)
+        if count:
+            min_ids.append(min_id)
+            max_ids.append(max_id)
+            total_count += count
+
+    if not total_count:
+        logger.info(f'No documents in {collection.name} created {start_datetime} - {end_datetime}')
+        return None, None, 0
+    logger.info(f'{collection.name} created {start_datetime} - {end_datetime}: _id {min(min_ids)} - {max(max_ids)}, count = {total_count}')
+    return min(min_ids), max(max_ids), total_count
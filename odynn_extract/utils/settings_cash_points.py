@@ -3,6 +3,8 @@ import logging, os
 import pandas as pd
 import numpy as np
 
+from utils.table_utils import enforce_dtypes
+
 input_output_dict = {
     'cash': {
         'input_tables': {
@@ -20,6 +22,10 @@ input_output_dict = {
             },
         'output_table': {
             'table_name': 'hotel_cash',
+            'load_method': 'copy', # 'copy' (COPY FROM STDIN) or 'to_sql'
+            # Partition new tables by month of created_at. Or list partition: {'method': 'list', 'column': 'hotel_group'}
+            'partition': {'method': 'range', 'column': 'created_at', 'interval': 'month'},
+            'indexes': ['_id', 'created_at'], # built after the load in --load_mode staging
             'table_columns': {
                 'hotel_group': 'TEXT',
                 'hotel_name': 'TEXT',
@@ -52,6 +58,9 @@ input_output_dict = {
             },
         'output_table': {
             'table_name': 'hotel_points',
+            'load_method': 'copy',
+            'partition': {'method': 'range', 'column': 'created_at', 'interval': 'month'},
+            'indexes': ['_id', 'created_at'],
             'table_columns': {
                 'hotel_group': 'TEXT',
                 'hotel_name': 'TEXT',
@@ -72,7 +81,35 @@ input_output_dict = {
     }
 }
 
-def query_cash_points(input_table, start_id):
+# Columns added by the extractor at load time rather than read from Mongo
+helper_column_names = ['run_id', 'hotel_group', 'input_table', 'chunk_n', 'extract_dt']
+
+# Low-cardinality text columns, held as categoricals from decode through load
+category_columns = ['hotel_group', 'hotel_name', 'hotel_name_key', 'award_category', 'currency', 'points_level', 'input_table', 'run_id']
+# In-memory dtype for each Postgres type. TEXT columns not in category_columns stay Python strings
+postgres_dtypes = {
+    'INTEGER': 'Int32',
+    'BIGINT': 'Int64',
+    'NUMERIC': 'float64',
+    'DATE': 'datetime64[ns]',
+    'TIMESTAMP': 'datetime64[ns]',
+}
+
+def dtypes_cash_points(table_columns):
+    # Compact pandas dtypes for an output table's columns, enforced on chunks from decode through load
+    dtypes = {}
+    for column, data_type in table_columns.items():
+        if column in category_columns:
+            dtypes[column] = 'category'
+        elif data_type in postgres_dtypes:
+            dtypes[column] = postgres_dtypes[data_type]
+    return dtypes
+
+def projection_cash_points(table_columns):
+    # Mongo fields to fetch for an output table: its schema minus the helper columns
+    return [column for column in table_columns if column not in helper_column_names]
+
+def query_cash_points(input_table, start_id, lower_id=None):
     # is_archived = True if input_table.split("_")[0] == 'archived' else False
     hotel_group = input_table.split('_')[-1]
     
@@ -86,51 +123,76 @@ def query_cash_points(input_table, start_id):
     # If last_id is defined, append an _id filter to the query dictionary
     if start_id:
         query['_id'] = {'$lt': ObjectId(start_id)}
+    
+    # Bound the downward scan from below when extracting a single _id range
+    if lower_id:
+        query.setdefault('_id', {})['$gte'] = ObjectId(lower_id)
         
     return query
 
-def clean_cash(df, column_order, logger):
+# Aggregation pipeline that filters, flattens and parses a chunk inside Mongo (see pipeline_cash_points)
+def pipeline_cash_points(table_type, query, projection, sort_column, sort_order, chunk_size):
+    # Keep only rows clean_cash/clean_points would keep. Filtering happens before $limit, so the last
+    # document of each chunk is still a valid start_id for the next chunk
+    if table_type == 'cash':
+        valid_filter = {'cash_value': {'$type': 'object'}}
+    else:
+        valid_filter = {'points': {'$ne': None}}
+    
+    project = {field: 1 for field in projection}
+    # $convert parses date strings like $dateFromString, but also passes through values already stored as dates
+    project['date'] = {'$convert': {'input': '$date', 'to': 'date', 'onError': None, 'onNull': None}}
+    if table_type == 'cash':
+        project['cash_value'] = {'$convert': {'input': '$cash_value.amount', 'to': 'double', 'onError': None, 'onNull': None}}
+        project['currency'] = '$cash_value.currency'
+    
+    return [
+        {'$match': {**query, **valid_filter}},
+        {'$sort': {sort_column: sort_order}},
+        {'$limit': chunk_size},
+        {'$project': project},
+    ]
+
+def clean_cash(df, column_order, logger, flattened=False, dtypes=None):
      # Check if cash_value exists
     try:
         if 'cash_value' in df.columns:
             # Reorder and drop unneeded columns for speed
             df = df.reindex(columns=column_order, fill_value=np.nan)
 
-            # Keep only rows where cash_value exists as a dictionary
-            df = df[df['cash_value'].apply(lambda x: isinstance(x, dict))]
+            # Keep only rows where cash_value exists as a dictionary (already filtered and flattened by Mongo if flattened)
+            if not flattened:
+                is_dict = np.fromiter((isinstance(x, dict) for x in df['cash_value'].values), dtype=bool, count=len(df))
+                df = df[is_dict]
             
+            # No valid rows is an empty frame, not an error (None), so the chunk is skipped rather than ending the range
             if df.empty:
-                df = None
-                return None
-            
-            # Convert date to datetime and ignore errors
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
-            # Drop rows where 'date' is NaT
-            df = df.dropna(subset=['date'])
-            
-            # Flatten 'cash_value' dictionary into distinct columns ('records' specifies the format)
-            df = pd.json_normalize(df.to_dict('records'))
+                return df
             
-            # Avoid creating dupe 'currency' col from renaming flattened cash_value dictionary
-            df = df.drop(columns=['currency'])
+            # Pull amount and currency out of the cash_value dicts in bulk, instead of a to_dict/json_normalize round trip
+            if not flattened:
+                df = df.assign(currency=df['cash_value'].str.get('currency'), cash_value=df['cash_value'].str.get('amount'))
             
-            # Rename flattened columns
-            df = df.rename(columns={'cash_value.amount': 'cash_value', 'cash_value.currency': 'currency'})
-            
-            # Convert cash_value to numeric type
-            df['cash_value'] = df['cash_value'].apply(pd.to_numeric, errors='coerce')
-            
-            # Convert data types for insertion for postgres insertion
-            df['_id'] = df['_id'].astype(str)
+            # Parse dates, convert cash_value to numeric type and _id to text, a whole column at a time
+            df = df.assign(
+                date=pd.to_datetime(df['date'], errors='coerce'),
+                cash_value=pd.to_numeric(df['cash_value'], errors='coerce'),
+                _id=df['_id'].astype(str),
+            )
+            # Drop rows where 'date' is NaT
+            df = df.dropna(subset=['date']).reset_index(drop=True)
+            if dtypes:
+                df = enforce_dtypes(df, dtypes)
             
             logger.debug(f'Cleaned df to {len(df)} rows')
             return df
+        return df.reindex(columns=column_order).iloc[:0]
         
     except Exception as e:
         logger.error(f'Error parsing cash {df} with column_order = {column_order}. {e}')
         return None
 
-def clean_points(df, column_order, logger):
+def clean_points(df, column_order, logger, flattened=False, dtypes=None):
     try:
         if 'points' in df.columns:  # only try to process the chunk if 'points' column exists
             # Reorder and drop unneeded columns for speed
@@ -140,19 +202,21 @@ def clean_points(df, column_order, logger):
             df = df[df['points'].notnull()]
             
             if df.empty:
-                df = None
-                return None
+                return df
             
-            # Convert date to datetime and ignore errors
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
+            # Parse dates and convert _id to text for postgres insertion, a whole column at a time
+            df = df.assign(
+                date=pd.to_datetime(df['date'], errors='coerce'),
+                _id=df['_id'].astype(str),
+            )
             # Drop rows where 'date' is NaT
-            df = df.dropna(subset=['date'])
-            
-            # Convert data types for postgres insertion
-            df['_id'] = df['_id'].astype(str)
+            df = df.dropna(subset=['date']).reset_index(drop=True)
+            if dtypes:
+                df = enforce_dtypes(df, dtypes)
             
             logger.info(f'Cleaned df to {len(df)} rows')
             return df
+        return df.reindex(columns=column_order).iloc[:0]
         
     except Exception as e:
         logger.error(f'Error parsing points {df} with column_order = {column_order}. {e}')
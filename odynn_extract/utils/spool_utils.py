@@ -0,0 +1,92 @@
+import os
+from datetime import datetime
+
+# Local Parquet spool of load-ready chunks, laid out as
+# {spool_dir}/{output_table}/hotel_group=<hotel_group>/created_day=<YYYY-MM-DD>/<input_table>-<min_id>-<max_id>.parquet
+# Each file carries the run_id, input_table, chunk_n and _id range it came from as Parquet key-value metadata,
+# so replay_spool.py can reload Postgres without going back to Mongo. pyarrow is only imported when spooling
+spool_metadata_prefix = 'odynn.'
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('pyarrow is needed for the Parquet spool (pip install pyarrow)') from e
+    return pyarrow, pyarrow.parquet
+
+def write_spool_chunk(df, spool_dir, output_table, metadata, logger, compression='zstd'):
+    # Write one load-ready chunk (helper columns included), one file per hotel_group and created_at day, named after
+    # the chunk's input_table and _id range. If any file fails, the files already written are removed before raising
+    pa, pq = import_pyarrow()
+    created_days = df['created_at'].dt.strftime('%Y-%m-%d').fillna('unknown')
+    hotel_groups = df['hotel_group'].astype(str)
+    file_paths = []
+    try:
+        for (hotel_group, created_day), partition_df in df.groupby([hotel_groups, created_days], sort=False):
+            partition_dir = os.path.join(spool_dir, output_table, f'hotel_group={hotel_group}', f'created_day={created_day}')
+            os.makedirs(partition_dir, exist_ok=True)
+            file_path = os.path.join(partition_dir, f"{metadata['input_table']}-{metadata['min_id']}-{metadata['max_id']}.parquet")
+
+            table = pa.Table.from_pandas(partition_df, preserve_index=False)
+            spool_metadata = {f'{spool_metadata_prefix}{key}': str(value) for key, value in metadata.items()}
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), **spool_metadata})
+            file_paths.append(file_path)
+            pq.write_table(table, file_path, compression=compression)
+    except Exception:
+        remove_spool_files(file_paths, logger)
+        raise
+
+    logger.debug(f"Spooled {len(df)} rows of chunk {metadata['chunk_n']} to {len(file_paths)} files under {os.path.join(spool_dir, output_table)}")
+    return file_paths
+
+def remove_spool_files(file_paths, logger):
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f'Error removing spool file {file_path}, it may be replayed twice. {e}')
+
+def remove_unloaded_spool_chunks(spool_dir, output_table, input_table, lower_id, start_id, logger):
+    # Remove the spooled chunks of input_table within [lower_id, start_id), i.e. below a resumed checkpoint, which were
+    # spooled but never committed before an interruption. The resumed run spools them again, possibly sized differently
+    table_dir = os.path.join(spool_dir, output_table)
+    file_paths = []
+    for partition_dir, _, file_names in os.walk(table_dir):
+        for file_name in file_names:
+            chunk_table, _, id_range = file_name[:-len('.parquet')].partition('-')
+            chunk_min_id, _, chunk_max_id = id_range.partition('-')
+            if (file_name.endswith('.parquet') and chunk_table == input_table and (lower_id is None or chunk_min_id >= str(lower_id))
+                    and (start_id is None or chunk_max_id < str(start_id))):
+                file_paths.append(os.path.join(partition_dir, file_name))
+    if file_paths:
+        logger.info(f'Removing {len(file_paths)} spool files of {input_table} that were spooled but not loaded before resuming')
+        remove_spool_files(file_paths, logger)
+
+def list_spool_files(spool_dir, output_table, hotel_groups=None, start_date=None, end_date=None):
+    # Spooled files of output_table, optionally only for some hotel_groups and created days in [start_date, end_date)
+    table_dir = os.path.join(spool_dir, output_table)
+    file_paths = []
+    for group_dir in sorted(os.listdir(table_dir)) if os.path.isdir(table_dir) else []:
+        hotel_group = group_dir.split('=', 1)[-1]
+        if hotel_groups and hotel_group not in hotel_groups:
+            continue
+        for day_dir in sorted(os.listdir(os.path.join(table_dir, group_dir))):
+            created_day = day_dir.split('=', 1)[-1]
+            if created_day != 'unknown' and (start_date or end_date):
+                created_dt = datetime.fromisoformat(created_day)
+                if (start_date and created_dt < start_date) or (end_date and created_dt >= end_date):
+                    continue
+            partition_dir = os.path.join(table_dir, group_dir, day_dir)
+            file_paths.extend(os.path.join(partition_dir, file_name) for file_name in sorted(os.listdir(partition_dir)) if file_name.endswith('.parquet'))
+    return file_paths
+
+def read_spool_file(file_path):
+    # Returns the spooled DataFrame (pandas dtypes such as categoricals restored) and its spool metadata dict
+    pa, pq = import_pyarrow()
+    table = pq.read_table(file_path)
+    metadata = {key.decode()[len(spool_metadata_prefix):]: value.decode() for key, value in (table.schema.metadata or {}).items()
+                if key.decode().startswith(spool_metadata_prefix)}
+    return table.to_pandas(), metadata
@@ -1,4 +1,5 @@
-import os, traceback
+import os, io, queue, threading, traceback
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
@@ -7,49 +8,357 @@ from pymongo import MongoClient
 
 load_dotenv() # lond environmental variables
 
-def extract_mongodb(mongo_database, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, env_str):
+def current_rss_mb():
+    # Resident memory of this process in MB, from /proc on Linux. Elsewhere falls back to the peak RSS so far
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        import resource, sys
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024 # bytes on macOS, KB on Linux
+
+baseline_rss = {} # RSS when this process first sized chunks, shared by every ChunkSizer (and worker thread) in it
+
+def process_baseline_rss_mb():
+    if 'mb' not in baseline_rss:
+        baseline_rss['mb'] = current_rss_mb()
+    return baseline_rss['mb']
+
+def frame_bytes(df, sample_size=1000):
+    # Approximate in-memory bytes of df. memory_usage(deep=True) sizes every Python object (~0.3 s per 1M rows), so only
+    # object columns are sized deep, on sample_size evenly spaced rows scaled up to the whole frame
+    shallow = df.memory_usage(index=True)
+    object_columns = [column for column in df.columns if df[column].dtype == object]
+    if not object_columns or len(df) <= sample_size:
+        return int(df.memory_usage(index=True, deep=True).sum()) if object_columns else int(shallow.sum())
+    sample = df[object_columns].iloc[::len(df) // sample_size]
+    object_bytes = sample.memory_usage(index=False, deep=True).sum() * len(df) / len(sample)
+    return int(shallow.drop(object_columns).sum() + object_bytes)
+
+class ChunkSizer:
+    # Picks each chunk's limit() from what earlier chunks cost, so one setting suits wide, narrow and mostly-malformed
+    # collections alike. Memory: the last chunk's in-memory bytes per document (times overhead, for decoded documents and
+    # cleaned copies held alongside the frame) must fit chunks_in_flight chunks into memory_budget_mb above the RSS at start.
+    # memory_budget_mb caps the whole process, so the shared_workers threads of one process each get an equal share of it.
+    # Time: the next chunk should take about target_seconds. Sizes change by at most max_growth per chunk, and the chunk is
+    # halved at once if RSS is over budget, before the worker gets OOM-killed. With neither target the size stays fixed
+    def __init__(self, initial_size, logger, memory_budget_mb=None, target_seconds=None, chunks_in_flight=1,
+                 min_size=1000, max_size=None, max_growth=2.0, overhead=3.0, shared_workers=1):
+        self.size = initial_size
+        self.logger = logger
+        self.memory_budget_mb = memory_budget_mb
+        self.target_seconds = target_seconds
+        self.chunks_in_flight = chunks_in_flight
+        self.min_size = min(min_size, initial_size)
+        self.max_size = max_size
+        self.max_growth = max_growth
+        self.overhead = overhead
+        self.shared_workers = max(shared_workers, 1)
+        self.baseline_rss_mb = process_baseline_rss_mb() if memory_budget_mb else None
+    
+    def clamp(self, size):
+        size = max(self.min_size, size)
+        return min(self.max_size, size) if self.max_size else size
+    
+    def next_size(self):
+        # Limit for the next chunk, shrinking first if the process is already over its memory budget
+        if self.memory_budget_mb:
+            rss_mb = current_rss_mb()
+            if rss_mb > self.memory_budget_mb and self.size > self.min_size:
+                self.size = self.clamp(self.size // 2)
+                self.logger.warning(f'RSS {rss_mb:.0f} MB over budget of {self.memory_budget_mb} MB, shrinking chunks to {self.size}')
+        return self.size
+    
+    def observe(self, docs, chunk_bytes, seconds):
+        # Resize from one finished chunk: docs fetched, its in-memory bytes and its fetch + clean + load seconds
+        if docs <= 0 or not (self.memory_budget_mb or self.target_seconds):
+            return self.size
+        
+        sizes = [int(self.size * self.max_growth)]
+        if self.memory_budget_mb:
+            mb_per_doc = chunk_bytes * self.overhead / docs / 1024 ** 2
+            headroom_mb = max(self.memory_budget_mb - self.baseline_rss_mb, 0) / self.shared_workers
+            sizes.append(int(headroom_mb / self.chunks_in_flight / max(mb_per_doc, 1e-9)))
+        if self.target_seconds and seconds > 0:
+            sizes.append(int(docs * self.target_seconds / seconds))
+        
+        new_size = self.clamp(max(min(sizes), int(self.size / self.max_growth)))
+        if new_size != self.size:
+            self.logger.info(f'Resizing chunks {self.size} -> {new_size} after {docs} docs, {chunk_bytes / 1024 ** 2:.0f} MB in {seconds:.1f}s')
+            self.size = new_size
+        return self.size
+
+def columnar_frame(cursor, fields, dtypes=None):
+    # Build a DataFrame column by column as documents stream off the cursor, so each decoded document is
+    # dropped right away instead of holding a list of every document alongside the DataFrame.
+    # Columns with a dtype in dtypes (e.g. 'category') are converted as each list is turned into a column
+    columns = {field: [] for field in fields}
+    for document in cursor:
+        for field, values in columns.items():
+            values.append(document.get(field))
+    dtypes = dtypes or {}
+    return pd.DataFrame({field: pd.Series(columns.pop(field), dtype=dtypes.get(field)) for field in fields})
+
+def add_helper_columns(df, helper_columns, dtypes=None):
+    # Set each helper_columns value on every row of df. Constant text helpers in dtypes as 'category' are
+    # built as one-category codes rather than a Python string per row
+    if helper_columns is not None:
+        for column, value in helper_columns.items():
+            if dtypes and dtypes.get(column) == 'category' and value is not None:
+                df[column] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), categories=[value])
+            else:
+                df[column] = value
+    return enforce_dtypes(df, dtypes) if dtypes else df
+
+def enforce_dtypes(df, dtypes):
+    # Cast the columns of df listed in dtypes (see dtypes_cash_points), skipping missing or already-cast columns
+    casts = {column: dtype for column, dtype in dtypes.items() if column in df.columns and df[column].dtype != dtype}
+    return df.astype(casts) if casts else df
+
+class DedupeIndex:
+    # Run-scoped index of row keys already extracted from one collection, so duplicates that straddle chunk
+    # boundaries are dropped too. Keys are 64-bit hashes of key_fields, kept in a sorted uint64 array
+    # (8 bytes per row), or in a fixed-size Bloom filter of bloom_bits bits to bound memory on huge collections.
+    # A Bloom filter can wrongly drop a small fraction of unique rows (false positives), never keep a duplicate
+    def __init__(self, key_fields, bloom_bits=None, bloom_hashes=4):
+        self.key_fields = key_fields
+        self.seen = np.empty(0, dtype=np.uint64)
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self.bloom = np.zeros((bloom_bits + 7) // 8, dtype=np.uint8) if bloom_bits else None
+    
+    def row_keys(self, df):
+        return pd.util.hash_pandas_object(df[self.key_fields], index=False).to_numpy()
+    
+    def bloom_positions(self, keys):
+        # Double hashing: bit i of a key is (h1 + i * h2) mod bloom_bits
+        h1 = keys
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        return [(h1 + np.uint64(i) * h2) % np.uint64(self.bloom_bits) for i in range(self.bloom_hashes)]
+    
+    def contains(self, keys):
+        if self.bloom is not None:
+            found = np.ones(len(keys), dtype=bool)
+            for positions in self.bloom_positions(keys):
+                found &= (self.bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+            return found
+        idx = np.searchsorted(self.seen, keys)
+        return (idx < len(self.seen)) & (self.seen[np.minimum(idx, len(self.seen) - 1)] == keys) if len(self.seen) else np.zeros(len(keys), dtype=bool)
+    
+    def add(self, keys):
+        if self.bloom is not None:
+            for positions in self.bloom_positions(keys):
+                np.bitwise_or.at(self.bloom, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        else:
+            # Both inputs are sorted, so the stable sort is effectively a linear merge
+            self.seen = np.sort(np.concatenate([self.seen, np.sort(keys)]), kind='stable')
+    
+    def drop_seen(self, df):
+        # Keep the first row of each key within df, unless that key was already seen in an earlier chunk
+        keys = self.row_keys(df)
+        keep = ~pd.Series(keys).duplicated().to_numpy() & ~self.contains(keys)
+        self.add(keys[keep])
+        return df[keep]
+
+def run_pipelined(chunks, transform, load, max_queued, logger):
+    # Iterate chunks (the fetch stage), transform and load them in three threads joined by bounded queues, so chunk N+1
+    # is fetched and transformed while chunk N loads. A full queue blocks the stage before it (backpressure), so at
+    # most 2 * max_queued + 3 chunks are in memory. load returns False to stop every stage.
+    # Returns True if every fetched chunk was loaded
+    done = object()
+    stop_event = threading.Event()
+    fetched = queue.Queue(maxsize=max_queued)
+    transformed = queue.Queue(maxsize=max_queued)
+    
+    def put(out_queue, item):
+        # Give up instead of blocking forever once a later stage has stopped
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def get(in_queue):
+        while not stop_event.is_set():
+            try:
+                return in_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+        return done
+    
+    def fetch_stage():
+        try:
+            for chunk in chunks:
+                if not put(fetched, chunk):
+                    return
+        except Exception as e:
+            logger.error(f'Error in fetch stage. {e} \n{traceback.format_exc()}')
+            stop_event.set()
+        finally:
+            put(fetched, done)
+    
+    def transform_stage():
+        try:
+            while (chunk := get(fetched)) is not done:
+                if not put(transformed, transform(chunk)):
+                    return
+        except Exception as e:
+            logger.error(f'Error in transform stage. {e} \n{traceback.format_exc()}')
+            stop_event.set()
+        finally:
+            put(transformed, done)
+    
+    threads = [threading.Thread(target=fetch_stage, daemon=True), threading.Thread(target=transform_stage, daemon=True)]
+    for thread in threads:
+        thread.start()
+    
+    all_loaded = False
+    try:
+        while (chunk := get(transformed)) is not done:
+            if not load(chunk):
+                break
+        else:
+            all_loaded = not stop_event.is_set()
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    return all_loaded
+
+# pipeline, if given, replaces find(query) with an aggregation (e.g. from pipeline_cash_points) that already sorts and limits
+# dedupe_index, if given, also drops rows whose last dedupe_fields key was seen in earlier chunks of the collection.
+# df.attrs['last_id'] holds the last sort_column value fetched (before deduping), the start point for the next chunk
+def extract_mongodb(mongo_database, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, env_str, session=None, projection=None, pipeline=None, dedupe_index=None, dtypes=None):
     # env_str = "MONGO_URI" # Now set in main code and passing into function
-    uri = os.environ.get(env_str)
+    # Without a long-lived session, open a short-lived one just for this call
+    if session is None:
+        with ExtractionSession(env_str, mongo_database) as session:
+            return extract_mongodb(mongo_database, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, env_str, session, projection, pipeline, dedupe_index, dtypes)
     
     try:
-        with MongoClient(uri) as client:
-            collection = client[mongo_database][input_table]
-            
+        # Check if the collection is empty (no documents), counted once per collection per session
+        if session.collection_size(input_table) == 0:
+            logger.error(f'Table {input_table} is empty (no documents).')
+            return None
+        
+        # Categoricals are lossless, so low-cardinality string columns are compacted as soon as they are decoded
+        decode_dtypes = {column: dtype for column, dtype in (dtypes or {}).items() if dtype == 'category'}
+        collection = session.collection(input_table)
+        if pipeline is not None:
+            cursor = collection.aggregate(pipeline)
+            df = columnar_frame(cursor, list(dict.fromkeys([sort_column, *projection])), decode_dtypes) if projection is not None else pd.DataFrame(list(cursor))
+        elif projection is not None:
+            # Only fetch and decode the listed fields (plus the sort_column), one column per field
+            fields = list(dict.fromkeys([sort_column, *projection]))
+            cursor = collection.find(query, {field: 1 for field in fields}).sort([(sort_column, sort_order)]).limit(chunk_size)
+            df = columnar_frame(cursor, fields, decode_dtypes)
+        else:
             cursor = collection.find(query).sort([(sort_column, sort_order)]).limit(chunk_size)
             df = pd.DataFrame(list(cursor))
-            # Check if the collection is empty (no documents)
-            if collection.count_documents({}) == 0:
-                logger.error(f'Table {input_table} is empty (no documents).')
-                return None
+        df = enforce_dtypes(df, decode_dtypes)
+        
+        first_id = df[sort_column].iloc[0] if not df.empty and sort_column in df.columns else None
+        last_id = df[sort_column].iloc[-1] if not df.empty and sort_column in df.columns else None
+        fetched_count = len(df)
+        
+        # Dedupe the data based on specified fields
+        if dedupe_fields and not df.empty:
+            # Integer day number (days since epoch) instead of a slow object column of datetime.date
+            df['created_date'] = df['created_at'].values.astype('datetime64[D]').astype(np.int64)
             
-            # Dedupe the data based on specified fields
-            if dedupe_fields:
-                df['created_date'] = df['created_at'].dt.date
-                
-                for dedupe_field in dedupe_fields:
-                    initial_row_count = len(df)
-                    df = df.drop_duplicates(subset=dedupe_field, keep="first")
-                    rows_deleted = initial_row_count - len(df)
-                    if rows_deleted > 0:
-                        logger.info(f"Deduped {rows_deleted} rows based on fields {dedupe_field}")
-                
-                df = df.drop(columns=['created_date']) # remove the temporary field used for deduping
-                
+            for dedupe_field in dedupe_fields:
+                initial_row_count = len(df)
+                df = df.drop_duplicates(subset=dedupe_field, keep="first")
+                rows_deleted = initial_row_count - len(df)
+                if rows_deleted > 0:
+                    logger.info(f"Deduped {rows_deleted} rows based on fields {dedupe_field}")
+            
+            if dedupe_index is not None:
+                initial_row_count = len(df)
+                df = dedupe_index.drop_seen(df)
+                rows_deleted = initial_row_count - len(df)
+                if rows_deleted > 0:
+                    logger.info(f"Deduped {rows_deleted} rows seen in earlier chunks based on fields {dedupe_index.key_fields}")
+            
+            df = df.drop(columns=['created_date']) # remove the temporary field used for deduping
+        
+        df.attrs['first_id'] = first_id
+        df.attrs['last_id'] = last_id
+        df.attrs['fetched_count'] = fetched_count # documents read from Mongo, before dedupe
         logger.debug(f'Extracted {len(df)} rows from {input_table} via {query}')
         return df
     except Exception as e:
-        breakpoint()
         logger.error(f'Error extracting from {input_table} via {query} sorted {sort_column} by {sort_order}. {e} \n{traceback.format_exc()}')
         return None
 
 
+class ExtractionSession:
+    # Owns one pooled MongoClient and one PostgresInserter for a whole run (or one worker), so no connection
+    # setup or collection counts happen per chunk. pool_size caps both pools, e.g. 1 per parallel worker.
+    # mongo_client reuses an existing client (e.g. an in-process stand-in for benchmarks) instead of connecting to env_str
+    def __init__(self, env_str, mongo_database, pool_size=None, mongo_client=None):
+        uri = os.environ.get(env_str)
+        if mongo_client is not None:
+            self.mongo_client = mongo_client
+        elif uri is None:
+            raise ValueError(f"{env_str} not found in environment variables")
+        elif pool_size is not None:
+            self.mongo_client = MongoClient(uri, maxPoolSize=pool_size)
+        else:
+            self.mongo_client = MongoClient(uri)
+        self.mongo_database = mongo_database
+        self.pool_size = pool_size
+        self.collection_sizes = {}
+        self._postgres = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    @property
+    def postgres(self):
+        # Created on first use, so Mongo-only callers don't need POSTGRESQL_URI
+        if self._postgres is None:
+            self._postgres = PostgresInserter(pool_size=self.pool_size)
+        return self._postgres
+    
+    def collection(self, input_table):
+        return self.mongo_client[self.mongo_database][input_table]
+    
+    def collection_size(self, input_table):
+        # Metadata-based count, cached for the life of the session
+        if input_table not in self.collection_sizes:
+            self.collection_sizes[input_table] = self.collection(input_table).estimated_document_count()
+        return self.collection_sizes[input_table]
+    
+    def extract(self, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, projection=None, pipeline=None, dedupe_index=None, dtypes=None):
+        return extract_mongodb(self.mongo_database, input_table, query, chunk_size, sort_column, sort_order, dedupe_fields, logger, None, self, projection, pipeline, dedupe_index, dtypes)
+    
+    def close(self):
+        self.mongo_client.close()
+        if self._postgres is not None:
+            self._postgres.close()
+
+
 class PostgresInserter:
-    def __init__(self):
+    def __init__(self, pool_size=None):
         env_str = "POSTGRESQL_URI"
         self.uri = os.environ.get(env_str)
         if self.uri is None:
             raise ValueError(f"{env_str} not found in environment variables")
-        self.engine = create_engine(self.uri)
+        # pool_size caps the connections this inserter can hold open (e.g. 1 per parallel worker)
+        if pool_size is not None:
+            self.engine = create_engine(self.uri, pool_size=pool_size, max_overflow=0)
+        else:
+            self.engine = create_engine(self.uri)
+        self.partitioned_tables = {} # table_name -> whether it is partitioned in Postgres
+        self.unlogged_tables = {} # table_name -> whether it is UNLOGGED (staging tables, see create_table)
+        self.partitions = set() # partitions known to exist, so each is only created once per inserter
         
     def __enter__(self):
         return self
@@ -57,41 +366,282 @@ class PostgresInserter:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def create_table(self, table_name, columns_dict, logger):
+    def create_table(self, table_name, columns_dict, logger, constraints=None, partition=None, unlogged=False):
         # Define the columns and generate "create table" query
         column_definitions = [f"{column} {data_type}" for column, data_type in columns_dict.items()]
         # column_definitions.append("id SERIAL PRIMARY KEY")
-        create_table_query = f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(column_definitions)})"
+        if constraints is not None:
+            column_definitions.extend(constraints) # table constraints, e.g. a composite PRIMARY KEY
+        # unlogged skips WAL for bulk loads into a staging table (Postgres only), see publish_staging_table
+        unlogged = 'UNLOGGED ' if unlogged and self.engine.dialect.name == 'postgresql' else ''
+        create_table_query = f"CREATE {unlogged}TABLE IF NOT EXISTS {table_name} ({', '.join(column_definitions)})"
+        
+        # A partition spec (see input_output_dict) makes a partitioned parent, plus a default partition for rows with
+        # no partition yet (e.g. NULL keys). Partitions for the keys of each chunk are added by ensure_partitions.
+        # A partitioned parent holds no rows and can't be unlogged, so an unlogged table's partitions are instead
+        queries = [create_table_query]
+        if partition is not None and self.engine.dialect.name == 'postgresql':
+            queries[0] = f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(column_definitions)}) PARTITION BY {partition['method'].upper()} ({partition['column']})"
+            queries.append(f"CREATE {unlogged}TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT")
         try:
             with self.engine.connect() as connection:
                 connection.execution_options(isolation_level="AUTOCOMMIT")
-                logger.debug(f"Executing query: {create_table_query}")
-                connection.execute(text(create_table_query))
+                for query in queries:
+                    create_table_query = query
+                    logger.debug(f"Executing query: {create_table_query}")
+                    connection.execute(text(create_table_query))
             return list(columns_dict.keys()) # Return list of column names
         except Exception as e:
             logger.error(f"Error executing query {create_table_query} {e}")
             return None
             
-    def insert_postgres(self, df: pd.DataFrame, table_name: str, logger, helper_columns=None, column_order=None):
+    def is_partitioned(self, table_name):
+        # Whether table_name is a partitioned parent. Tables created before partition specs were added stay plain heaps
+        if table_name not in self.partitioned_tables:
+            select_query = text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table_name));")
+            with self.engine.connect() as connection:
+                self.partitioned_tables[table_name] = bool(connection.execute(select_query, {'table_name': table_name}).scalar())
+        return self.partitioned_tables[table_name]
+    
+    def is_unlogged(self, table_name):
+        # Whether table_name is UNLOGGED. For a partitioned parent, whether its default partition is
+        if table_name not in self.unlogged_tables:
+            select_query = text("SELECT relpersistence = 'u' FROM pg_class WHERE oid = to_regclass(:table_name);")
+            with self.engine.connect() as connection:
+                self.unlogged_tables[table_name] = bool(connection.execute(select_query, {'table_name': table_name}).scalar())
+        return self.unlogged_tables[table_name]
+    
+    def list_partitions(self, table_name):
+        select_query = text("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(:table_name) ORDER BY 1;")
+        with self.engine.connect() as connection:
+            return [row[0] for row in connection.execute(select_query, {'table_name': table_name})]
+    
+    def ensure_partitions(self, df, table_name, partition, logger):
+        # Create any partitions of table_name that rows of df fall into, before they are loaded. Range partitions cover
+        # one partition['interval'] ('day', 'month' or 'year') of partition['column']; list partitions one value each
+        if partition is None or self.engine.dialect.name != 'postgresql':
+            return
+        first_check = table_name not in self.partitioned_tables
+        if not self.is_partitioned(table_name):
+            if first_check:
+                logger.warning(f"{table_name} already exists unpartitioned, loading it without partitions {partition}")
+            return
+        
+        column = partition['column']
+        partition_bounds = {}
+        if partition['method'] == 'range':
+            interval = partition.get('interval', 'month')
+            period, suffix_format, step = {'day': ('D', '%Y_%m_%d', pd.DateOffset(days=1)),
+                                           'month': ('M', '%Y_%m', pd.DateOffset(months=1)),
+                                           'year': ('Y', '%Y', pd.DateOffset(years=1))}[interval]
+            for start in pd.to_datetime(df[column]).dropna().dt.to_period(period).dt.start_time.unique():
+                start = pd.Timestamp(start)
+                partition_bounds[f"{table_name}_p{start.strftime(suffix_format)}"] = f"FROM ('{start:%Y-%m-%d}') TO ('{start + step:%Y-%m-%d}')"
+        else:
+            for value in pd.Series(df[column]).dropna().astype(str).unique():
+                suffix = ''.join(character if character.isalnum() else '_' for character in value.lower())
+                partition_bounds[f"{table_name}_p_{suffix}"] = f"IN ('{value.replace(chr(39), chr(39) * 2)}')"
+        
+        unlogged = 'UNLOGGED ' if self.is_unlogged(f'{table_name}_default') else ''
+        for partition_name, bounds in partition_bounds.items():
+            if partition_name in self.partitions:
+                continue
+            create_query = f"CREATE {unlogged}TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} FOR VALUES {bounds}"
+            try:
+                with self.engine.connect() as connection:
+                    connection.execution_options(isolation_level="AUTOCOMMIT")
+                    connection.execute(text(create_query))
+                logger.info(f"Created partition {partition_name} of {table_name}")
+            except Exception as e:
+                # Usually another worker creating the same partition at the same moment
+                logger.warning(f"Error creating partition {partition_name}: {e}")
+            self.partitions.add(partition_name)
+    
+    def copy_rows(self, cursor, df, table_name, batch_size=100000):
+        # Stream df into table_name via COPY FROM STDIN on cursor, batch_size rows at a time
+        # NaN/None (and empty strings) are written as unquoted empty CSV fields, which COPY loads as NULL
+        copy_query = f"COPY {table_name} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)"
+        for start in range(0, len(df), batch_size):
+            buffer = io.StringIO()
+            df.iloc[start:start + batch_size].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(copy_query, buffer)
+    
+    def copy_postgres(self, df: pd.DataFrame, table_name: str, batch_size=100000):
+        # COPY df into table_name in a single transaction
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                self.copy_rows(cursor, df, table_name, batch_size)
+            connection.commit()
+        except Exception:
+            connection.rollback() # nothing from this df is committed, so falling back to to_sql is safe
+            raise
+        finally:
+            connection.close()
+
+    def merge_key_columns(self, table_name, partition=None):
+        # Columns rows are merged on: _id, plus the partition column when table_name is partitioned, since a unique
+        # index on a partitioned table must include it. A document's created_at never changes, so _id alone still decides
+        if partition is not None and self.engine.dialect.name == 'postgresql' and self.is_partitioned(table_name):
+            return ['_id', partition['column']]
+        return ['_id']
+    
+    def create_merge_index(self, table_name, key_columns, logger):
+        # Unique index that INSERT ... ON CONFLICT merges against. Fails if table_name already holds duplicate keys,
+        # e.g. from earlier appends, which have to be removed first (see the dupes check in odynn_transform/cash_qa.sql)
+        index_query = f"CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_merge_key_idx ON {table_name} ({', '.join(key_columns)})"
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                logger.debug(f"Executing query: {index_query}")
+                connection.execute(text(index_query))
+            return True
+        except Exception as e:
+            logger.error(f"Error creating unique index on {table_name} ({', '.join(key_columns)}), remove its duplicate rows before merging into it. {e}")
+            return False
+    
+    def merge_postgres(self, df: pd.DataFrame, table_name: str, key_columns, batch_size=100000):
+        # COPY df into a temp table, then upsert it into table_name on key_columns in the same transaction, so loading
+        # the same rows again updates them in place instead of duplicating them. Returns the rows inserted or updated
+        if self.engine.dialect.name != 'postgresql':
+            raise ValueError(f"Merge loads need Postgres, not {self.engine.dialect.name}")
+        merge_table = f"{table_name.split('.')[-1]}_merge"
+        columns = ', '.join(df.columns)
+        update_columns = ', '.join(f"{column} = EXCLUDED.{column}" for column in df.columns if column not in key_columns)
+        # DISTINCT ON: a row may only be updated once per statement, so keep one row per key from the chunk itself
+        merge_query = (f"INSERT INTO {table_name} ({columns}) SELECT DISTINCT ON ({', '.join(key_columns)}) {columns} FROM {merge_table} "
+                       f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {update_columns}")
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE TEMP TABLE {merge_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP")
+                self.copy_rows(cursor, df, merge_table, batch_size)
+                cursor.execute(merge_query)
+                merged_count = cursor.rowcount
+            connection.commit()
+            return merged_count
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    # Returns the number of rows saved, or None if the load failed. With merge_keys rows are upserted on those
+    # columns (see merge_postgres) instead of appended, whatever the load_method
+    def insert_postgres(self, df: pd.DataFrame, table_name: str, logger, helper_columns=None, column_order=None, load_method='to_sql', dtypes=None, partition=None, merge_keys=None):
         if df is None:
             logger.warning(f"No data to save to {table_name}. Skipping.")
-            return
+            return 0
         # Add optional helper_columns via dictionary
-        if helper_columns is not None:
-            for column, value in helper_columns.items():
-                df[column] = value
+        df = add_helper_columns(df, helper_columns, dtypes)
                 
         # Standardize column order if provided
         if column_order is not None:
             df = df[column_order]
+        
+        # Partitioned tables get any partitions this chunk needs first, so no rows land in the default partition
+        if partition is not None:
+            try:
+                self.ensure_partitions(df, table_name, partition, logger)
+            except Exception as e:
+                logger.error(f"Error creating partitions of {table_name} for {partition}: {e}")
+                return None
             
+        # No to_sql fallback for merges: appending would bring back the duplicates the merge exists to avoid
+        if merge_keys:
+            try:
+                merged_count = self.merge_postgres(df, table_name, merge_keys)
+                logger.info(f"Merged {len(df)} rows into {table_name} on {', '.join(merge_keys)} ({merged_count} inserted or updated)")
+                return len(df)
+            except Exception as e:
+                logger.error(f"Error merging data into {table_name}: {e}")
+                return None
+        
+        # Bulk load via COPY when requested, falling back to to_sql if COPY fails
+        if load_method == 'copy':
+            try:
+                self.copy_postgres(df, table_name)
+                logger.info(f"Copied {len(df)} rows to {table_name}")
+                return len(df)
+            except Exception as e:
+                logger.warning(f"COPY into {table_name} failed, falling back to to_sql. {e}")
+        
         # Save DataFrame to PostgreSQL table
         try:
             df.to_sql(table_name, self.engine, index=False, if_exists='append', chunksize = 100000) # Testing
             logger.info(f"Saved {len(df)} rows to {table_name}")
+            return len(df)
         except Exception as e:
             logger.error(f"Error saving data to {table_name}: \n{traceback.format_exc()}")
+            return None
             
+    def staging_table_name(self, table_name):
+        return f"{table_name}_staging"
+    
+    def create_staging_table(self, table_name, columns_dict, logger, partition=None, keep_existing=False):
+        # UNLOGGED, index-free copy of table_name for a bulk load, published by publish_staging_table. Any earlier
+        # staging table is dropped unless keep_existing (e.g. when resuming the run that was loading it)
+        staging_name = self.staging_table_name(table_name)
+        if not keep_existing:
+            self.drop_table(staging_name, logger)
+        column_order = self.create_table(staging_name, columns_dict, logger, partition=partition, unlogged=True)
+        return staging_name, column_order
+    
+    def drop_table(self, table_name, logger):
+        drop_query = f"DROP TABLE IF EXISTS {table_name}"
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(text(drop_query))
+            self.partitioned_tables.pop(table_name, None)
+            self.unlogged_tables.pop(f'{table_name}_default', None)
+            self.unlogged_tables.pop(table_name, None)
+            self.partitions = {partition for partition in self.partitions if not partition.startswith(f'{table_name}_p')}
+        except Exception as e:
+            logger.error(f"Error dropping {table_name}: {e}")
+    
+    def publish_staging_table(self, table_name, logger, index_columns=None):
+        # Index, analyze and SET LOGGED the staging table of table_name, then swap it in for table_name in one
+        # transaction, so readers see either the old table or the fully loaded new one. Returns True if published
+        staging_name = self.staging_table_name(table_name)
+        index_columns = index_columns or []
+        try:
+            partitions = self.list_partitions(staging_name)
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                # Build indexes once over the loaded rows, instead of maintaining them row by row during the load
+                for column in index_columns:
+                    logger.info(f"Indexing {staging_name} on {column}")
+                    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {staging_name}_{column}_idx ON {staging_name} ({column})"))
+                connection.execute(text(f"ANALYZE {staging_name}"))
+                # Write the table to WAL once, so it survives a crash from here on
+                for logged_table in partitions or [staging_name]:
+                    connection.execute(text(f"ALTER TABLE {logged_table} SET LOGGED"))
+                # Indexes Postgres named after the staging table or its partitions, renamed along with them below
+                index_query = text("SELECT i.relname FROM pg_index JOIN pg_class i ON i.oid = indexrelid WHERE indrelid = ANY(CAST(:tables AS regclass[]));")
+                index_names = [row[0] for row in connection.execute(index_query, {'tables': [staging_name, *partitions]}) if row[0].startswith(staging_name)]
+            
+            # Without CASCADE, objects depending on table_name (e.g. views) make the swap fail and roll back instead
+            with self.engine.begin() as connection:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+                connection.execute(text(f"ALTER TABLE {staging_name} RENAME TO {table_name}"))
+                for partition_name in partitions:
+                    connection.execute(text(f"ALTER TABLE {partition_name} RENAME TO {table_name}{partition_name[len(staging_name):]}"))
+                for index_name in index_names:
+                    connection.execute(text(f"ALTER INDEX {index_name} RENAME TO {table_name}{index_name[len(staging_name):]}"))
+        except Exception as e:
+            logger.error(f"Error publishing {staging_name} as {table_name}, staging table kept: {e}")
+            return False
+        
+        for name in [table_name, staging_name]:
+            self.partitioned_tables.pop(name, None)
+            self.unlogged_tables.pop(f'{name}_default', None)
+            self.unlogged_tables.pop(name, None)
+        self.partitions = set()
+        logger.info(f"Published {staging_name} as {table_name}")
+        return True
+    
     def start_run(self, run_name, prefix, logger, details=None):
         run_dt = datetime.utcnow()
         table_name = f"{prefix}run"
@@ -116,5 +666,132 @@ class PostgresInserter:
         except Exception as e:
             logger.error(f"Error adding run {run_id} of {run_name} into {table_name}: {e} \n {insert_query}")
         
+    def get_max_id(self, table_name, input_table, logger):
+        # Highest _id already loaded from input_table. _id is stored as 24-char lowercase hex, so text order matches ObjectId order.
+        # The (input_table, _id) index, built once by the first --incremental run, turns the max into one index probe
+        index_query = text(f"CREATE INDEX IF NOT EXISTS {table_name}_input_table_id_idx ON {table_name} (input_table, _id)")
+        select_query = text(f"SELECT max(_id) FROM {table_name} WHERE input_table = :input_table;")
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(index_query)
+                return connection.execute(select_query, {'input_table': input_table}).scalar()
+        except Exception as e:
+            logger.error(f"Error getting max _id for {input_table} from {table_name}: {e}")
+            return None
+    
+    def create_checkpoint_table(self, prefix, logger):
+        table_name = f"{prefix}run_checkpoint"
+        
+        # One row per (run_name, prefix, input_table, _id range), updated after every committed chunk
+        columns_dict = {
+            'run_name': 'TEXT NOT NULL',
+            'prefix': 'TEXT NOT NULL',
+            'input_table': 'TEXT NOT NULL',
+            'range_key': 'TEXT NOT NULL',
+            'lower_id': 'TEXT',
+            'upper_id': 'TEXT',
+            'start_id': 'TEXT',
+            'chunk_n': 'INTEGER',
+            'rows_inserted': 'BIGINT',
+            'completed': 'BOOLEAN',
+            'run_id': 'INTEGER',
+            'updated_dt': 'TIMESTAMP',
+            }
+        self.create_table(table_name, columns_dict, logger, constraints=['PRIMARY KEY (run_name, prefix, input_table, range_key)'])
+        return table_name
+    
+    def save_checkpoint(self, checkpoint, logger):
+        # Upsert checkpoint dict (keys match create_checkpoint_table columns) after a chunk is committed
+        table_name = f"{checkpoint['prefix']}run_checkpoint"
+        checkpoint = {**checkpoint, 'updated_dt': datetime.utcnow()}
+        columns = list(checkpoint.keys())
+        key_columns = ['run_name', 'prefix', 'input_table', 'range_key']
+        update_columns = [f"{column} = EXCLUDED.{column}" for column in columns if column not in key_columns]
+        upsert_query = text(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(f':{column}' for column in columns)}) "
+                            f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {', '.join(update_columns)};")
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(upsert_query, checkpoint)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving checkpoint {checkpoint} into {table_name}: {e}")
+            return False
+    
+    def load_checkpoints(self, run_name, prefix, input_table, logger):
+        # Returns the saved checkpoints (as dicts) for every _id range of input_table
+        table_name = f"{prefix}run_checkpoint"
+        select_query = text(f"SELECT * FROM {table_name} WHERE run_name = :run_name AND prefix = :prefix AND input_table = :input_table ORDER BY lower_id NULLS FIRST;")
+        try:
+            with self.engine.connect() as connection:
+                result = connection.execute(select_query, {'run_name': run_name, 'prefix': prefix, 'input_table': input_table})
+                return [dict(row._mapping) for row in result]
+        except Exception as e:
+            logger.error(f"Error loading checkpoints for {input_table} from {table_name}: {e}")
+            return []
+    
+    def create_chunk_metrics_table(self, prefix, logger):
+        table_name = f"{prefix}run_chunk_metrics"
+        
+        # One row per loaded chunk: sizes after each stage and time spent in each, for finding slow collections/stages in SQL
+        columns_dict = {
+            'run_id': 'INTEGER',
+            'run_name': 'TEXT',
+            'input_table': 'TEXT',
+            'output_table': 'TEXT',
+            'worker_name': 'TEXT',
+            'chunk_n': 'INTEGER',
+            'min_id': 'TEXT',
+            'max_id': 'TEXT',
+            'docs_fetched': 'INTEGER',
+            'rows_after_dedupe': 'INTEGER',
+            'rows_cleaned': 'INTEGER',
+            'rows_inserted': 'INTEGER',
+            'fetched_bytes': 'BIGINT',
+            'cleaned_bytes': 'BIGINT',
+            'fetch_seconds': 'DOUBLE PRECISION',
+            'clean_seconds': 'DOUBLE PRECISION',
+            'load_seconds': 'DOUBLE PRECISION',
+            'created_dt': 'TIMESTAMP',
+            }
+        self.create_table(table_name, columns_dict, logger)
+        # Metrics tables created before rows_deduped was renamed keep their rows under the new name
+        rename_query = text("SELECT 1 FROM information_schema.columns WHERE table_name = :table_name AND column_name = 'rows_deduped';")
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                if connection.execute(rename_query, {'table_name': table_name}).scalar():
+                    connection.execute(text(f"ALTER TABLE {table_name} RENAME COLUMN rows_deduped TO rows_after_dedupe"))
+        except Exception as e:
+            logger.error(f"Error renaming rows_deduped of {table_name} to rows_after_dedupe: {e}")
+        return table_name
+    
+    def save_chunk_metrics(self, prefix, chunk_metrics, logger):
+        # Insert chunk_metrics dict (keys match create_chunk_metrics_table columns). Failures are logged, never fatal to the run
+        table_name = f"{prefix}run_chunk_metrics"
+        chunk_metrics = {**chunk_metrics, 'created_dt': datetime.utcnow()}
+        columns = list(chunk_metrics.keys())
+        insert_query = text(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(f':{column}' for column in columns)});")
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(insert_query, chunk_metrics)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving chunk metrics {chunk_metrics} into {table_name}: {e}")
+            return False
+    
+    def clear_checkpoints(self, run_name, prefix, input_table, logger, completed_only=False):
+        table_name = f"{prefix}run_checkpoint"
+        completed_filter = " AND completed" if completed_only else ""
+        delete_query = text(f"DELETE FROM {table_name} WHERE run_name = :run_name AND prefix = :prefix AND input_table = :input_table{completed_filter};")
+        try:
+            with self.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(delete_query, {'run_name': run_name, 'prefix': prefix, 'input_table': input_table})
+        except Exception as e:
+            logger.error(f"Error clearing checkpoints for {input_table} from {table_name}: {e}")
+        
     def close(self):
         self.engine.dispose()  # Close the database engine
\ No newline at end of file
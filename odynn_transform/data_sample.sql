@@ -1,6 +1,7 @@
 -- V2 - Odynn TABLE CREATION FOR FORBES SAMPLE --
 
 ---- CREATE CLEAN TABLES ---- 
+-- Full rebuild. odynn_extract/transform_clean_tables.py applies steps 1-2 incrementally, merging only rows from new extract runs
 ---- 1. cash ---- 
 DROP TABLE IF EXISTS hotel_cash;
 CREATE TABLE hotel_cash AS